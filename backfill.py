@@ -0,0 +1,260 @@
+import fcntl
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from config import *
+from data_fetcher import *
+import metrics
+import raw_archive
+import transport
+
+# Resumable historical backfill of the *_monthly tables. The work list of
+# (year, month, table) units and their status lives in a SQLite file, so a
+# crash or a worker timeout only loses the units that were in flight. Fetches
+# run one at a time through the shared rate limiter; building the DataFrames
+# and writing them to MySQL happens in a worker pool meanwhile.
+
+MONTHS = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
+          'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+
+
+def connect_backfill_db():
+    connection = sqlite3.connect(BACKFILL_DB, timeout=30, check_same_thread=False)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_units (
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            tabla TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            pilgrims INTEGER,
+            error TEXT,
+            updated_at REAL,
+            PRIMARY KEY (year, month, tabla)
+        )""")
+    return connection
+
+
+def plan_backfill(connection, start_year, end_year, end_month):
+    # Adds the missing units up to end_year/end_month; existing units keep their status
+    units = [(year, month, item['tabla'])
+             for year in range(start_year, end_year + 1)
+             for month in range(1, 13)
+             if year < end_year or month <= end_month
+             for item in queries_tables]
+    with connection:
+        connection.executemany(
+            "INSERT OR IGNORE INTO backfill_units (year, month, tabla) VALUES (?, ?, ?)", units)
+
+
+def reopen_unfinished_months(connection):
+    # A month loaded before it ended (always the current one) only has partial
+    # data, so it goes back to the queue until a load after its last day
+    with connection:
+        connection.execute("""
+            UPDATE backfill_units SET status = 'pending'
+            WHERE status = 'done'
+              AND updated_at < CAST(strftime('%s', printf('%04d-%02d-01', year, month), '+1 month') AS REAL)""")
+
+
+def backfill_progress():
+    connection = connect_backfill_db()
+    try:
+        counts = dict(connection.execute(
+            "SELECT status, COUNT(*) FROM backfill_units GROUP BY status").fetchall())
+    finally:
+        connection.close()
+    counts['total'] = sum(counts.values())
+    return counts
+
+
+class BackfillRun:
+
+    def __init__(self, query_year_month, workers):
+        self.query_year_month = query_year_month
+        self.workers = workers
+        self.connection = connect_backfill_db()
+        self.db_lock = threading.Lock()
+        # Limits how many decoded responses wait in memory for a worker
+        self.in_flight = threading.BoundedSemaphore(workers * 2)
+        self.columns_by_dimension = dimension_columns(query_year_month)
+        self.window = query_window(query_year_month)
+        self.items = {item['tabla']: item for item in queries_tables}
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    def set_status(self, year, month, tabla, status, pilgrims=None, error=None):
+        with self.db_lock, self.connection:
+            self.connection.execute(
+                """UPDATE backfill_units
+                   SET status = ?, pilgrims = COALESCE(?, pilgrims), error = ?, updated_at = ?,
+                       attempts = attempts + (? = 'running')
+                   WHERE year = ? AND month = ? AND tabla = ?""",
+                (status, pilgrims, error, time.time(), status, year, month, tabla))
+
+    def count(self, status):
+        with self.db_lock:
+            setattr(self, status, getattr(self, status) + 1)
+
+    def pending_periods(self):
+        # {(year, month): [tablas pendientes]} en orden cronológico
+        rows = self.connection.execute(
+            """SELECT year, month, tabla FROM backfill_units
+               WHERE status IN ('pending', 'failed') ORDER BY year, month""").fetchall()
+        periods = {}
+        for year, month, tabla in rows:
+            periods.setdefault((year, month), []).append(tabla)
+        return periods
+
+    def log_progress(self, remaining):
+        elapsed = time.monotonic() - self.started
+        finished = self.done + self.failed
+        rate = finished / elapsed if elapsed > 0 else 0
+        eta = (remaining - finished) / rate if rate > 0 else None
+        eta_text = f"{eta / 60:.1f} min" if eta is not None else "unknown"
+        logging.info(f"Backfill: {self.done} done, {self.failed} failed, "
+                     f"{remaining - finished} left, ETA {eta_text}")
+
+    def store(self, year, month, tabla, df):
+        stats_date = datetime(year, month, 1).strftime('%Y-%m-%d')
+        with metrics.stage('store', tabla + 'monthly'):
+            if insert_data_into_db(df, tabla + 'monthly', stats_date, incremental=True) is None:
+                raise RuntimeError(f"insert into {tabla}monthly failed")
+        metrics.record_rows('store', tabla + 'monthly', len(df))
+        self.set_status(year, month, tabla, 'done', pilgrims=int(df['M0'].sum()))
+
+    def targets_of(self, tabla, pending):
+        # Pending units written from the response of `tabla`
+        return [target for target in pending
+                if target == tabla or self.items[target].get('derived_from') == tabla]
+
+    def fail(self, year, month, targets, error):
+        logging.error(f"Backfill {year}-{month:02d} {', '.join(targets)}: {error}")
+        for target in targets:
+            self.set_status(year, month, target, 'failed', error=str(error))
+            self.count('failed')
+
+    def fetch(self, year, month, tabla, targets):
+        # Decoded response of `tabla` for the month, or None if the request failed
+        try:
+            query = adjust_query_bytes(self.query_year_month, self.items[tabla]['dimensions'],
+                                       year, MONTHS[month - 1])
+            wait_for_rate_limit()
+            with metrics.stage('fetch', tabla + 'monthly'):
+                decoded = read_stream(raw_archive.archive_events(
+                    fetch_events(query, throttle=False), tabla + 'monthly',
+                    datetime(year, month, 1).strftime('%Y-%m-%d')))
+            metrics.record_payload(tabla + 'monthly', *transport.last_request_bytes())
+            return decoded
+        except Exception as e:
+            self.fail(year, month, targets, e)
+            return None
+
+    def truncated(self, decoded):
+        columns_data = decoded[1]
+        rows = len(columns_data[0]) if columns_data else 0
+        return self.window is not None and rows >= self.window
+
+    def process(self, year, month, tabla, decoded, targets, remaining):
+        # Builds and stores the fetched table and the tables derived from it
+        try:
+            with metrics.stage('build_dataframe', tabla + 'monthly'):
+                df = stream_to_dataframe(decoded, self.items[tabla]['dimensions'])
+            for target in targets:
+                try:
+                    dimensions = self.items[target]['dimensions']
+                    target_df = df if target == tabla else rollup_dataframe(
+                        df, [self.columns_by_dimension[dim] for dim in dimensions], dimensions)
+                    self.store(year, month, target, target_df)
+                    self.count('done')
+                except Exception as e:
+                    self.fail(year, month, [target], e)
+        except Exception as e:
+            self.fail(year, month, targets, e)
+        finally:
+            self.log_progress(remaining)
+            self.in_flight.release()
+
+    def run(self):
+        periods = self.pending_periods()
+        remaining = sum(len(tablas) for tablas in periods.values())
+        logging.info(f"Backfill: {remaining} units pending")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for (year, month), pending in periods.items():
+                # tablas que hay que pedir a PBI: las pendientes que no son
+                # derivadas y el origen de las derivadas pendientes
+                to_fetch = []
+                for tabla in pending:
+                    source = self.items[tabla].get('derived_from', tabla)
+                    if source not in to_fetch:
+                        to_fetch.append(source)
+
+                for tabla in to_fetch:
+                    targets = self.targets_of(tabla, pending)
+                    for target in targets:
+                        self.set_status(year, month, target, 'running')
+                    decoded = self.fetch(year, month, tabla, targets)
+                    if decoded is None:
+                        continue
+
+                    derived = [target for target in targets if target != tabla]
+                    if derived and self.truncated(decoded):
+                        # la respuesta llena la ventana de filas y puede venir
+                        # cortada: las derivadas se piden directamente
+                        logging.warning(f"Backfill {year}-{month:02d} {tabla}: response reaches the "
+                                        f"query window, fetching {', '.join(derived)} directly")
+                        for target in derived:
+                            target_decoded = self.fetch(year, month, target, [target])
+                            if target_decoded is not None:
+                                self.in_flight.acquire()
+                                executor.submit(self.process, year, month, target, target_decoded,
+                                                [target], remaining)
+                        targets = [target for target in targets if target == tabla]
+                        if not targets:
+                            continue
+
+                    self.in_flight.acquire()
+                    executor.submit(self.process, year, month, tabla, decoded, targets, remaining)
+
+        return {'done': self.done, 'failed': self.failed, 'seconds': time.monotonic() - self.started}
+
+
+def run_backfill(query_year_month, start_year=2003, workers=BACKFILL_WORKERS, restart=False):
+    # Only one backfill at a time per work list. restart=True discards the
+    # previous work list and loads every month again
+    with open(BACKFILL_DB + '.lock', 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError("A backfill is already running")
+
+        run = BackfillRun(query_year_month, workers)
+        try:
+            if restart:
+                with run.connection:
+                    run.connection.execute("DELETE FROM backfill_units")
+            now = datetime.now()
+            plan_backfill(run.connection, start_year, now.year, now.month)
+            # units left running by a crashed run go back to the queue
+            with run.connection:
+                run.connection.execute(
+                    "UPDATE backfill_units SET status = 'pending' WHERE status = 'running'")
+            reopen_unfinished_months(run.connection)
+
+            summary = run.run()
+
+            # el total del último mes de la última tabla, como update_stats_year_month
+            row = run.connection.execute(
+                "SELECT pilgrims FROM backfill_units WHERE year = ? AND month = ? AND tabla = ?",
+                (now.year, now.month, queries_tables[-1]['tabla'])).fetchone()
+            summary['pilgrims'] = row[0] if row else None
+            logging.info(f"Backfill finished: {summary}")
+            return summary
+        finally:
+            run.connection.close()
@@ -0,0 +1,146 @@
+import glob
+import gzip
+import json
+import os
+import random
+
+import transport
+
+# Power BI DSR payloads for the benchmarks. The synthetic ones mimic what the
+# service returns: rows sorted by the grouping columns, repeated leading
+# values sent through the "R" bitset, nulls through "Ø", dimension values as
+# ValueDict indexes and the measure as an "123L" string. Recorded responses
+# dropped in benchmarks/recorded/ are picked up as extra fixtures: raw JSON
+# saved from PBI (.json or .json.gz) or files written by TRANSPORT_MODE=record
+# (.gz, copied from TRANSPORT_ARCHIVE_DIR). None is shipped until there is a
+# capture of the live service.
+
+RECORDED_DIR = os.path.join(os.path.dirname(__file__), 'recorded')
+
+# Propiedades de las dimensiones y número de valores distintos de cada una
+DIMENSIONS = {
+    'd1': ('Camino', 14),
+    'd2': ('Medio', 4),
+    'd3': ('Sexo', 3),
+    'd4': ('Origen', 60),
+    'd5': ('Pais', 180),
+    'd6': ('Motivo', 3),
+    'd7': ('Edad', 4),
+}
+
+MONTHS = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
+          'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
+
+
+def dsr_payload(dimensions, rows, seed=0, null_ratio=0.02):
+    """Returns a DSR response grouped by `dimensions` with about `rows` rows."""
+    rnd = random.Random(seed)
+    properties = [DIMENSIONS[dim][0] for dim in dimensions]
+    cardinalities = [DIMENSIONS[dim][1] for dim in dimensions]
+    value_dicts = {f"D{i}": [f"{prop} {value}" + ("\n" if value % 17 == 0 else "")
+                             for value in range(cardinality)]
+                   for i, (prop, cardinality) in enumerate(zip(properties, cardinalities))}
+
+    # combinaciones distintas, ordenadas como las devuelve PBI
+    total = 1
+    for cardinality in cardinalities:
+        total *= cardinality
+    keys = set()
+    while len(keys) < min(rows, total):
+        keys.add(tuple(rnd.randrange(cardinality) for cardinality in cardinalities))
+
+    width = len(dimensions) + 1
+    types = [{"N": f"G{i}", "T": 1, "DN": f"D{i}"} for i in range(len(dimensions))] + [{"N": "M0", "T": 4}]
+    dm0 = []
+    previous = None
+    for key in sorted(keys):
+        values = [None if rnd.random() < null_ratio else value for value in key]
+        values.append(f"{rnd.randrange(1, 400)}L")
+        row = {}
+        if previous is None:
+            row["S"] = types
+            row["C"] = [value for value in values if value is not None]
+            nulls = sum(1 << i for i, value in enumerate(values) if value is None)
+        else:
+            copies = 0
+            nulls = 0
+            compressed = []
+            for i, value in enumerate(values):
+                if i < width - 1 and value is not None and value == previous[i]:
+                    copies |= 1 << i
+                elif value is None:
+                    nulls |= 1 << i
+                else:
+                    compressed.append(value)
+            if copies:
+                row["R"] = copies
+            row["C"] = compressed
+        if nulls:
+            row["Ø"] = nulls
+        dm0.append(row)
+        previous = values
+
+    select = [{"Kind": 1, "Value": f"G{i}", "GroupKeys": [{"Source": {"Property": prop}}]}
+              for i, prop in enumerate(properties)] + [{"Kind": 2, "Value": "M0"}]
+    return {"jobIds": [f"job-{seed}"], "results": [{"jobId": f"job-{seed}", "result": {"data": {
+        "descriptor": {"Select": select},
+        "dsr": {"DS": [{"PH": [{"DM0": dm0}], "ValueDicts": value_dicts}]}}}}]}
+
+
+def query_template():
+    """Returns a year/month query template shaped like the ones in db_queries_stats."""
+    from_section = [{"Name": dim, "Entity": f"Dim{prop}", "Type": 0}
+                    for dim, (prop, _) in DIMENSIONS.items()]
+    from_section += [{"Name": "m", "Entity": "Medidas", "Type": 0}, {"Name": "ym", "Entity": "date", "Type": 0}]
+    select = [{"Column": {"Expression": {"SourceRef": {"Source": dim}}, "Property": prop},
+               "Name": f"Dim{prop}.{prop}"} for dim, (prop, _) in DIMENSIONS.items()]
+    select.append({"Measure": {"Expression": {"SourceRef": {"Source": "m"}}, "Property": "Peregrinos"},
+                   "Name": "Medidas.Peregrinos"})
+    where = [
+        {"Condition": {"In": {"Expressions": [{"Column": {"Expression": {"SourceRef": {"Source": "ym"}}, "Property": "Año"}}],
+                              "Values": [[{"Literal": {"Value": "2024L"}}]]}}},
+        {"Condition": {"In": {"Expressions": [{"Column": {"Expression": {"SourceRef": {"Source": "ym"}}, "Property": "Mes"}}],
+                              "Values": [[{"Literal": {"Value": "'enero'"}}]]}}},
+    ]
+    return {"version": "1.0.0", "queries": [{"Query": {"Commands": [{"SemanticQueryDataShapeCommand": {
+        "Query": {"Version": 2, "From": from_section, "Select": select, "Where": where},
+        "Binding": {"Primary": {"Groupings": [{"Projections": [0, 1]}]},
+                    "DataReduction": {"DataVolume": 4, "Primary": {"Window": {"Count": 30000}}},
+                    "Version": 1}}}]}}],
+        "cancelQueries": [], "modelId": 1}
+
+
+def synthetic_fixtures():
+    # {nombre: (dimensiones, [respuestas serializadas])}
+    return {
+        'small': (['d2'], [json.dumps(dsr_payload(['d2'], 4, seed=1)).encode()]),
+        'cube': (['d1', 'd5', 'd4'],
+                 [json.dumps(dsr_payload(['d1', 'd5', 'd4'], 25000, seed=2)).encode()]),
+        'year': (['d1', 'd5', 'd4'],
+                 [json.dumps(dsr_payload(['d1', 'd5', 'd4'], 6000, seed=10 + month)).encode()
+                  for month in range(12)]),
+    }
+
+
+def read_recorded(path):
+    # Cuerpo de la respuesta guardada en `path`
+    if path.endswith('.json'):
+        with open(path, 'rb') as fixture_file:
+            return fixture_file.read()
+    if path.endswith('.json.gz'):
+        with gzip.open(path, 'rb') as fixture_file:
+            return fixture_file.read()
+    return transport.read_archive(path)[1]
+
+
+def recorded_fixtures(directory=RECORDED_DIR):
+    # Una respuesta por fichero; el número de dimensiones sale del descriptor
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json')) +
+                       glob.glob(os.path.join(directory, '*.gz'))):
+        raw = read_recorded(path)
+        select = json.loads(raw)["results"][0]["result"]["data"]["descriptor"]["Select"]
+        dimensions = [f"d{i + 1}" for i, item in enumerate(select) if item["Kind"] == 1]
+        name = 'recorded:' + os.path.basename(path).split('.')[0]
+        fixtures[name] = (dimensions, [raw])
+    return fixtures
@@ -0,0 +1,307 @@
+"""Benchmarks for the transform and load paths.
+
+Run from the repository root:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --fixtures cube --stages decode_stream --compare results.json
+
+Every stage is timed `--repeat` times over each fixture, and then run once
+more under tracemalloc for its peak memory. The results are printed, or
+written with --output, as JSON. --compare prints the change of each median
+against an earlier results file. db_load_sqlite reproduces the batching of
+_insert_data against an in-memory SQLite database; only --mysql-table runs
+insert_data_into_db itself, against a scratch table of the configured
+database whose columns must be date, one per dimension and the pilgrims count.
+The scratch table is emptied before every repeat: db_load_mysql times a load
+into the empty table and db_load_mysql_incremental a reload of the same data
+(INCREMENTAL_MODE decides whether that is a diff or a delete and insert).
+
+Fixtures: `small` (one dimension), `cube` (d1 x d5 x d4), `year` (twelve
+monthly cubes, like a backfill year), `query` (query building) and every
+response saved in benchmarks/recorded/ (raw JSON, or a file written by
+TRANSPORT_MODE=record). No recorded response is shipped: create the
+directory and copy captures of the live service into it. legacy_convert_to_dataframe is skipped above
+LEGACY_MAX_ROWS rows unless it is named in --stages.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+from config import BULK_BATCH_SIZE
+from data_transformer import (extract, convert_to_dataframe, decode_to_dataframe, decode_stream,
+                              stream_dsr, rollup_dataframe, build_query, adjust_query,
+                              adjust_query_bytes)
+from database_functions import dataframe_rows
+from benchmarks.fixtures import synthetic_fixtures, recorded_fixtures, query_template, MONTHS
+
+QUERY_CALLS = 1000
+# convert_to_dataframe añade las filas una a una con df.loc: con más filas
+# tarda minutos, solo se mide si se pide expresamente con --stages
+LEGACY_MAX_ROWS = 5000
+
+
+# Cada etapa es (preparación, medición): la preparación no se cronometra y
+# devuelve el estado que recibe la medición. Ambas reciben (dims, payloads).
+
+def stage_json_loads(dims, payloads):
+    return None, lambda state: [json.loads(raw) for raw in payloads]
+
+
+def stage_legacy_extract(dims, payloads):
+    # extract modifica la respuesta, se parte de una copia nueva en cada vuelta
+    return (lambda: [json.loads(raw) for raw in payloads],
+            lambda state: [extract(payload) for payload in state])
+
+
+def stage_legacy_convert_to_dataframe(dims, payloads):
+    return (lambda: [extract(json.loads(raw)) for raw in payloads],
+            lambda state: [convert_to_dataframe(columns, dm0, dims) for columns, dm0 in state])
+
+
+def stage_decode_to_dataframe(dims, payloads):
+    return (lambda: [json.loads(raw) for raw in payloads],
+            lambda state: [decode_to_dataframe(payload, dims) for payload in state])
+
+
+def stage_decode_stream(dims, payloads):
+    return None, lambda state: [decode_stream(stream_dsr(io.BytesIO(raw)), dims) for raw in payloads]
+
+
+def stage_rollup_dataframe(dims, payloads):
+    if len(dims) < 2:
+        return None
+    frames = [decode_to_dataframe(json.loads(raw), dims) for raw in payloads]
+    return None, lambda state: [rollup_dataframe(df, [df.columns[0]], dims[:1]) for df in frames]
+
+
+def stage_db_load_sqlite(dims, payloads):
+    # No ejecuta _insert_data, cuyo SQL es de MySQL: reproduce su carga (filas
+    # con dataframe_rows, executemany en lotes de BULK_BATCH_SIZE y un commit
+    # por fecha) contra una base SQLite en memoria. Mide la construcción de
+    # las filas y el coste de un executemany por lotes, no el servidor ni el
+    # diff; para eso está --mysql-table
+    frames = [decode_to_dataframe(json.loads(raw), dims) for raw in payloads]
+    columns = ['date'] + [f"dim{i}" for i in range(len(dims))] + ['pilgrims']
+    insert_query = (f"INSERT OR REPLACE INTO stats ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))})")
+
+    def setup():
+        connection = sqlite3.connect(':memory:')
+        connection.execute(f"CREATE TABLE stats ({', '.join(columns)}, "
+                           f"PRIMARY KEY ({', '.join(columns[:-1])}))")
+        return connection
+
+    def load(connection):
+        for month, df in enumerate(frames):
+            rows = dataframe_rows(df, f"2024-{month + 1:02d}-01")
+            for start in range(0, len(rows), BULK_BATCH_SIZE):
+                connection.executemany(insert_query, rows[start:start + BULK_BATCH_SIZE])
+            connection.commit()
+        connection.close()
+
+    return setup, load
+
+
+def stage_db_load_mysql(table, incremental):
+    # incremental=False carga los meses en la tabla vacía. incremental=True
+    # (INCREMENTAL_MODE) recarga los mismos meses sobre la tabla ya cargada, el
+    # caso de un refresco periódico: en modo diff no se envía ninguna fila y
+    # se mide solo la lectura y la comparación. La tabla se vacía antes de
+    # cada repetición para que todas midan lo mismo
+    def stage(dims, payloads):
+        from database_functions import db_connection, insert_data_into_db
+        frames = [decode_to_dataframe(json.loads(raw), dims) for raw in payloads]
+
+        def insert_all(incremental):
+            for month, df in enumerate(frames):
+                if insert_data_into_db(df, table, f"2024-{month + 1:02d}-01", incremental=incremental) is None:
+                    raise RuntimeError(f"insert into {table} failed")
+
+        def setup():
+            with db_connection() as connection:
+                if connection is None:
+                    raise RuntimeError("Failed to establish a connection.")
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(f"TRUNCATE TABLE {table}")
+                finally:
+                    cursor.close()
+            if incremental:
+                insert_all(False)
+
+        return setup, lambda state: insert_all(incremental)
+    return stage
+
+
+STAGES = {
+    'json_loads': stage_json_loads,
+    'legacy_extract': stage_legacy_extract,
+    'legacy_convert_to_dataframe': stage_legacy_convert_to_dataframe,
+    'decode_to_dataframe': stage_decode_to_dataframe,
+    'decode_stream': stage_decode_stream,
+    'rollup_dataframe': stage_rollup_dataframe,
+    'db_load_sqlite': stage_db_load_sqlite,
+}
+
+
+# Construcción de queries: no depende de la respuesta, se mide por llamada
+
+def query_stages():
+    template = query_template()
+    template_text = json.dumps(template)
+    dims = ['d1', 'd5', 'd4']
+    return {
+        'build_query': lambda: [build_query(template_text, dims, 2024, MONTHS[i % 12])
+                                for i in range(QUERY_CALLS)],
+        'adjust_query': lambda: [adjust_query(template, dims, 2024, MONTHS[i % 12])
+                                 for i in range(QUERY_CALLS)],
+        'adjust_query_bytes': lambda: [adjust_query_bytes(template, dims, 2024, MONTHS[i % 12])
+                                       for i in range(QUERY_CALLS)],
+    }
+
+
+def measure(setup, work, repeat):
+    timings = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        work(state)
+        timings.append(time.perf_counter() - start)
+
+    state = setup() if setup else None
+    tracemalloc.start()
+    try:
+        work(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return timings, peak
+
+
+def result(fixture, stage, items, input_bytes, timings, peak):
+    median = statistics.median(timings)
+    return {
+        'fixture': fixture,
+        'stage': stage,
+        'items': items,
+        'input_bytes': input_bytes,
+        'runs': len(timings),
+        'seconds_min': min(timings),
+        'seconds_median': median,
+        'items_per_second': items / median if median > 0 else None,
+        'peak_memory_bytes': peak,
+    }
+
+
+def count_rows(dims, payloads):
+    return sum(len(decode_to_dataframe(json.loads(raw), dims)) for raw in payloads)
+
+
+def metadata(repeat):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'repeat': repeat,
+    }
+
+
+def run(fixture_names=None, stage_names=None, repeat=5, mysql_table=None, recorded=True):
+    fixtures = synthetic_fixtures()
+    if recorded:
+        fixtures.update(recorded_fixtures())
+    stages = dict(STAGES)
+    if mysql_table:
+        stages['db_load_mysql'] = stage_db_load_mysql(mysql_table, incremental=False)
+        stages['db_load_mysql_incremental'] = stage_db_load_mysql(mysql_table, incremental=True)
+
+    results = []
+    for fixture, (dims, payloads) in fixtures.items():
+        if fixture_names and fixture not in fixture_names:
+            continue
+        rows = count_rows(dims, payloads)
+        input_bytes = sum(len(raw) for raw in payloads)
+        for stage, build in stages.items():
+            if stage_names and stage not in stage_names:
+                continue
+            if stage == 'legacy_convert_to_dataframe' and rows > LEGACY_MAX_ROWS and not stage_names:
+                print(f"{fixture:>12} {stage:<28} skipped ({rows} rows)", file=sys.stderr)
+                continue
+            prepared = build(dims, payloads)
+            if prepared is None:
+                continue
+            timings, peak = measure(*prepared, repeat)
+            results.append(result(fixture, stage, rows, input_bytes, timings, peak))
+            print(f"{fixture:>12} {stage:<28} {results[-1]['seconds_median'] * 1000:10.2f} ms "
+                  f"{peak / 2 ** 20:8.1f} MiB", file=sys.stderr)
+
+    if not fixture_names or 'query' in fixture_names:
+        for stage, work in query_stages().items():
+            if stage_names and stage not in stage_names:
+                continue
+            timings, peak = measure(None, lambda state: work(), repeat)
+            results.append(result('query', stage, QUERY_CALLS, None, timings, peak))
+            print(f"{'query':>12} {stage:<28} {results[-1]['seconds_median'] * 1000:10.2f} ms "
+                  f"{peak / 2 ** 20:8.1f} MiB", file=sys.stderr)
+
+    return {'meta': metadata(repeat), 'results': results}
+
+
+def compare(current, baseline):
+    # Cambio de la mediana respecto a otra ejecución (<1 es más rápido)
+    previous = {(item['fixture'], item['stage']): item for item in baseline['results']}
+    for item in current['results']:
+        before = previous.get((item['fixture'], item['stage']))
+        if before is None or not before['seconds_median']:
+            continue
+        ratio = item['seconds_median'] / before['seconds_median']
+        print(f"{item['fixture']:>12} {item['stage']:<28} {ratio:6.2f}x time "
+              f"({before['seconds_median'] * 1000:.2f} -> {item['seconds_median'] * 1000:.2f} ms)",
+              file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', nargs='*', help="fixture names (small, cube, year, query, recorded:<name>)")
+    parser.add_argument('--stages', nargs='*', help=f"stage names ({', '.join(STAGES)}, build_query, ...)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--compare', help="earlier JSON results to compare against")
+    parser.add_argument('--mysql-table', help="scratch table for the insert_data_into_db stage")
+    parser.add_argument('--no-recorded', action='store_true', help="skip benchmarks/recorded/")
+    args = parser.parse_args(argv)
+
+    results = run(args.fixtures, args.stages, args.repeat, args.mysql_table, not args.no_recorded)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 import os
+import tempfile
 
 # Load environment variables from the .env file
 load_dotenv()
@@ -8,6 +9,89 @@ load_dotenv()
 URL_OP_PBI = os.getenv('URL_OP_PBI')
 URL_OP_WEBSITE = os.getenv('URL_OP_WEBSITE')
 
+# Procesa las respuestas de PBI a medida que llegan en lugar de cargarlas enteras
+PBI_STREAMING = os.getenv('PBI_STREAMING', 'true').lower() == 'true'
+
+# Conexiones HTTP compartidas (pool keep-alive) y timeouts en segundos
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 120))
+
+# Grabación y reproducción de las peticiones HTTP: 'live' (normal), 'record'
+# (guarda cada respuesta en TRANSPORT_ARCHIVE_DIR) o 'replay' (responde desde
+# el archivo sin red, con REPLAY_LATENCY segundos más hasta REPLAY_JITTER de
+# retardo por petición)
+TRANSPORT_MODE = os.getenv('TRANSPORT_MODE', 'live').lower()
+TRANSPORT_ARCHIVE_DIR = os.getenv('TRANSPORT_ARCHIVE_DIR', os.path.join(tempfile.gettempdir(), 'http_archive'))
+REPLAY_LATENCY = float(os.getenv('REPLAY_LATENCY', 0))
+REPLAY_JITTER = float(os.getenv('REPLAY_JITTER', 0))
+
+# Número de queries a PBI en paralelo
+PBI_CONCURRENCY = int(os.getenv('PBI_CONCURRENCY', 4))
+
+# Presupuesto de peticiones a PBI por hora, compartido por todos los procesos
+# del host a través de RATE_LIMIT_FILE, y ráfaga máxima permitida
+PBI_HOURLY_BUDGET = int(os.getenv('PBI_HOURLY_BUDGET', 500))
+PBI_BURST = int(os.getenv('PBI_BURST', 10))
+RATE_LIMIT_FILE = os.getenv('RATE_LIMIT_FILE', os.path.join(tempfile.gettempdir(), 'pbi_rate_limit.json'))
+
+# Hash del contenido de la última respuesta cargada por (tabla, periodo): si
+# no cambia se omiten la decodificación y la escritura en base de datos
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_FILE = os.getenv('RESPONSE_CACHE_FILE', os.path.join(tempfile.gettempdir(), 'pbi_response_hashes.json'))
+
+# Carga histórica reanudable: fichero SQLite con la lista de trabajo y número
+# de hilos que construyen los DataFrames y escriben en base de datos
+BACKFILL_DB = os.getenv('BACKFILL_DB', os.path.join(tempfile.gettempdir(), 'pbi_backfill.sqlite3'))
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', 4))
+
+# Fechas que se piden a PBI en una sola consulta en update_stats_by_day
+PBI_DATES_PER_QUERY = int(os.getenv('PBI_DATES_PER_QUERY', 7))
+
+# Ejecución en segundo plano de los endpoints de actualización: fichero
+# SQLite con el estado de los trabajos e hilos por proceso que los ejecutan
+# (las cargas históricas usan un hilo aparte y no cuentan en JOB_WORKERS)
+JOBS_DB = os.getenv('JOBS_DB', os.path.join(tempfile.gettempdir(), 'stats_jobs.sqlite3'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 1))
+
+# Plantillas de consulta de db_queries_stats: cada cuántos segundos se
+# comprueba en segundo plano si han cambiado, y cuánto se espera antes de
+# reintentar la carga tras un fallo
+TEMPLATE_CHECK_INTERVAL = int(os.getenv('TEMPLATE_CHECK_INTERVAL', 60))
+TEMPLATE_RETRY_INTERVAL = int(os.getenv('TEMPLATE_RETRY_INTERVAL', 10))
+
+# Caché en memoria de las lecturas de / y /now: segundos de validez, segundos
+# extra en los que se sirve el valor caducado mientras se recarga en segundo
+# plano (0 lo desactiva) y directorio de los ficheros de versión compartidos
+READ_CACHE_TTL = int(os.getenv('READ_CACHE_TTL', 60))
+READ_CACHE_STALE = int(os.getenv('READ_CACHE_STALE', 0))
+READ_CACHE_DIR = os.getenv('READ_CACHE_DIR', tempfile.gettempdir())
+
+# Archivo de las respuestas en bruto de PBI, para poder volver a procesarlas
+# sin nuevas peticiones (python reprocess.py). Tiene que sobrevivir a los
+# reinicios, así que por defecto va en data/ junto a la aplicación y no en el
+# directorio temporal. No se borra nada: queda un fichero por tabla y periodo
+# (cada carga reemplaza el suyo), así que crece con cada día y mes cargado y
+# la limpieza de los periodos antiguos es cosa del despliegue
+RAW_ARCHIVE_ENABLED = os.getenv('RAW_ARCHIVE_ENABLED', 'true').lower() == 'true'
+RAW_ARCHIVE_DIR = os.getenv('RAW_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'pbi_raw_archive'))
+
+# API de lectura de las tablas stats_*: filas por página por defecto y máximo
+# (limit=0 descarga todo el resultado en streaming)
+STATS_PAGE_SIZE = int(os.getenv('STATS_PAGE_SIZE', 1000))
+STATS_MAX_PAGE_SIZE = int(os.getenv('STATS_MAX_PAGE_SIZE', 50000))
+# Cada lectura usa su propia conexión a MySQL, fuera del pool: máximo de
+# lecturas a la vez por proceso y segundos de espera por un hueco (luego 503)
+STATS_MAX_STREAMS = int(os.getenv('STATS_MAX_STREAMS', 4))
+STATS_STREAM_WAIT = float(os.getenv('STATS_STREAM_WAIT', 5))
+
+# Caché HTTP de las respuestas de lectura: cada cuántos segundos se espera una
+# nueva carga (el Cache-Control dura hasta entonces, con HTTP_CACHE_MAX_AGE
+# como máximo) y tamaño mínimo de respuesta que se comprime con gzip/brotli
+REFRESH_INTERVAL = int(os.getenv('REFRESH_INTERVAL', 3600))
+HTTP_CACHE_MAX_AGE = int(os.getenv('HTTP_CACHE_MAX_AGE', 300))
+HTTP_COMPRESS_MIN_BYTES = int(os.getenv('HTTP_COMPRESS_MIN_BYTES', 1024))
+
 # Other secrets
 api_key_hash = os.getenv('API_KEY_HASH')
 
@@ -25,12 +109,47 @@ db_config = {
     'database': os.getenv('DB_DATABASE')
 }
 
+# Pool de conexiones a MySQL: tamaño máximo, vida máxima de una conexión (s),
+# inactividad tras la que se comprueba con ping (s) y espera máxima por una conexión (s)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_POOL_MAX_LIFETIME = int(os.getenv('DB_POOL_MAX_LIFETIME', 1800))
+DB_POOL_HEALTH_CHECK = int(os.getenv('DB_POOL_HEALTH_CHECK', 30))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+
+# Carga masiva: filas por lote, tamaño máximo de cada INSERT multi-fila (debe
+# caber en max_allowed_packet) y si se hace commit tras cada lote o una sola vez
+# por tabla y fecha
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', 10000))
+BULK_MAX_STATEMENT_BYTES = int(os.getenv('BULK_MAX_STATEMENT_BYTES', 1024000))
+BULK_COMMIT_EVERY_BATCH = os.getenv('BULK_COMMIT_EVERY_BATCH', 'false').lower() == 'true'
+
+# Cargas incrementales: 'diff' compara con las filas guardadas y solo escribe
+# los cambios, 'replace' borra la fecha y vuelve a insertarla entera
+INCREMENTAL_MODE = os.getenv('INCREMENTAL_MODE', 'diff')
+
+# Cómo se escriben las tablas *_last_day en update_stats_last_day: 'inplace'
+# escribe la fecha directamente en una transacción; 'swap' carga una tabla
+# sombra y la intercambia con RENAME TABLE, de modo que los lectores nunca
+# esperan por los bloqueos de la carga, pero la sombra es una copia de todo el
+# histórico y cada refresco tarda en proporción a él
+LAST_DAY_PUBLISH_MODE = os.getenv('LAST_DAY_PUBLISH_MODE', 'inplace')
+
+# Segundos de espera por el bloqueo de escritura de una tabla (GET_LOCK), que
+# comparten todas las cargas y publicaciones de esa tabla
+TABLE_LOCK_TIMEOUT = int(os.getenv('TABLE_LOCK_TIMEOUT', 60))
+
+# Comprueba al arrancar el esquema de las tablas de queries_tables
+CHECK_SCHEMAS_ON_STARTUP = os.getenv('CHECK_SCHEMAS_ON_STARTUP', 'false').lower() == 'true'
+
+# "derived_from" indica que la tabla se calcula agregando localmente la
+# respuesta de otra entrada (que debe contener sus dimensiones) en lugar de
+# lanzar su propia query a PBI
 queries_tables = [
-    {"dimensions": ['d1'], "tabla": "stats_camino_"},
+    {"dimensions": ['d1'], "tabla": "stats_camino_", "derived_from": "stats_camino_country_origin_"},
     {"dimensions": ['d2'], "tabla": "stats_means_"},
     {"dimensions": ['d3'], "tabla": "stats_gender_"},
-    {"dimensions": ['d4'], "tabla": "stats_origin_"},
-    {"dimensions": ['d5'], "tabla": "stats_country_"},
+    {"dimensions": ['d4'], "tabla": "stats_origin_", "derived_from": "stats_camino_country_origin_"},
+    {"dimensions": ['d5'], "tabla": "stats_country_", "derived_from": "stats_camino_country_origin_"},
     {"dimensions": ['d6'], "tabla": "stats_motivo_"},
     {"dimensions": ['d7'], "tabla": "stats_age_"},
     {"dimensions": ['d1', 'd5', 'd4'], "tabla": "stats_camino_country_origin_"}
@@ -38,3 +157,5 @@ queries_tables = [
 
 tabla_check = 'stats_camino_country_origin_last_day'
 tabla_pilgrims_last_day = 'stats_pilgrims_last_day'
+# total de peregrinos por tabla y fecha, mantenido por las cargas
+tabla_daily_totals = 'daily_totals'
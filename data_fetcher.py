@@ -1,64 +1,227 @@
 import json
+import hashlib
 import requests
 from config import *
 from data_transformer import *
 from database_functions import *
+import transport
+import rate_limiter
+import response_cache
+import read_cache
+import metrics
+import raw_archive
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime
-import math
 from bs4 import BeautifulSoup
 import re
 import logging
 
 
-def fetch_data_day(query):
-    # Recuperar la información del servicio PBI
-    response = requests.post(URL_OP_PBI, headers=HEADERS, json=query)
-    return json.loads(response.text)
+def query_body(query):
+    # Las queries precompiladas ya vienen serializadas
+    if isinstance(query, bytes):
+        return {'data': query}
+    return {'json': query}
 
 
-def update_stats_last_day(query_last_day, query_year_month):
+def wait_for_rate_limit():
+    # Espera a que el presupuesto compartido permita otra petición a PBI. Las
+    # cargas la llaman antes de la etapa 'fetch' para que la espera no cuente
+    # como tiempo de descarga
+    metrics.record_rate_limit_wait(rate_limiter.acquire())
 
-    response_data = fetch_data_day(query_last_day)
-    info_last_day = extract_date_last_day(response_data)
 
-    # guarda la respuesta en la db
-    insert_data_into_db_last_day(info_last_day)
+def fetch_data_day(query, throttle=True):
+    # Recuperar la información del servicio PBI
+    if throttle:
+        wait_for_rate_limit()
+    response = transport.post(URL_OP_PBI, headers=HEADERS, **query_body(query))
+    return json.loads(response.text)
 
-    for item in queries_tables:
-        dimensions = item['dimensions']
-        tabla_db = item['tabla'] + 'last_day'
-        # primero ajusto la plantilla con cada una de las queries
-        query_pbi = adjust_query(query_year_month, dimensions)
 
-        # lanzo la petición a PBI
-        response_data = fetch_data_day(query_pbi)
+def stream_data_day(query, throttle=True):
+    # Recuperar la información del servicio PBI leyendo la respuesta por partes
+    if throttle:
+        wait_for_rate_limit()
+    with transport.stream('POST', URL_OP_PBI, headers=HEADERS, **query_body(query)) as body:
+        yield from stream_dsr(body)
+
+
+def fetch_events(query, throttle=True):
+    # Lanza la petición a PBI y devuelve los eventos de la respuesta; con
+    # throttle=False el llamante ya ha pasado por wait_for_rate_limit()
+    if PBI_STREAMING:
+        return stream_data_day(query, throttle)
+    return dsr_events(fetch_data_day(query, throttle))
+
+
+def fetch_dataframe(query, dimensions):
+    # Lanza la petición a PBI y devuelve directamente el DataFrame decodificado
+    return decode_stream(fetch_events(query), dimensions)
+
+
+def split_derived(items):
+    # Separa las tablas que se piden a PBI de las que se calculan localmente
+    # a partir de otra tabla (clave "derived_from" en queries_tables)
+    fetched_items = [item for item in items if 'derived_from' not in item]
+    derived_items = [item for item in items if 'derived_from' in item]
+    return fetched_items, derived_items
+
+
+def load_tables(query_template, build_query, suffix, stats_date, store, concurrency=1, report=None,
+                prefetched=None):
+    # Descarga, decodifica y guarda todas las tablas de queries_tables para
+    # un periodo. Las tablas derivadas se agregan a partir del DataFrame de su
+    # tabla origen sin hacer nuevas peticiones a PBI, salvo si la respuesta de
+    # la tabla origen llena la ventana de filas de la consulta y puede venir
+    # cortada: entonces se piden directamente. Si el contenido de una
+    # respuesta no ha cambiado desde la última carga no se vuelve a escribir.
+    # Devuelve el total de peregrinos (suma de M0) de cada tabla. Con
+    # `prefetched` ({tabla: df}) se guardan esos DataFrames sin pedirlos a PBI.
+    fetched_items, derived_items = split_derived(queries_tables)
+    columns_by_dimension = dimension_columns(query_template)
+    window = query_window(query_template)
+    dataframes = {}
+    totals = {}
+    # hash de las respuestas descargadas y tablas guardadas con éxito: el hash
+    # se guarda al final, solo si la tabla y sus derivadas se han guardado
+    content_hashes = {}
+    stored_tables = set()
+
+    def store_table(df, item):
+        tabla_db = item['tabla'] + suffix
+        with metrics.stage('store', tabla_db):
+            stored = store(df, tabla_db, stats_date)
+        if stored is None:
+            metrics.record_error('store', tabla_db)
+        else:
+            metrics.record_rows('store', tabla_db, len(df))
+            stored_tables.add(item['tabla'])
+        return stored
+
+    def truncated(df):
+        # una respuesta que llena la ventana de filas puede venir cortada
+        return window is not None and len(df) >= window
 
-        # extraigo los datos de cada una de las respuestas
-        columns, dm0_data = extract(response_data)
+    def load(item, direct=False):
+        # `direct` pide a PBI una tabla derivada en lugar de agregarla
+        dimensions = item['dimensions']
+        tabla_db = item['tabla'] + suffix
+        if prefetched is not None and not direct:
+            df = prefetched[item['tabla']]
+            store_table(df, item)
+            return df, int(df['M0'].sum())
+
+        # lanzo la petición a PBI y reconstruyo las columnas calculando el hash
+        digest = hashlib.sha256()
+        query = build_query(dimensions)
+        wait_for_rate_limit()
+        with metrics.stage('fetch', tabla_db):
+            events = raw_archive.archive_events(fetch_events(query, throttle=False), tabla_db, stats_date)
+            decoded = read_stream(events, digest)
+        metrics.record_payload(tabla_db, *transport.last_request_bytes())
+        content_hash = digest.hexdigest()
+
+        cached = response_cache.get_entry(tabla_db, stats_date) if RESPONSE_CACHE_ENABLED else None
+        if cached is not None and cached['hash'] == content_hash:
+            logging.info(f"{tabla_db} ({stats_date}): unchanged, skipped")
+            metrics.record_skipped(tabla_db)
+            return None, cached['total']
+
+        # transformo los datos para obtener un pandas que poder guardar en una base de datos
+        with metrics.stage('build_dataframe', tabla_db):
+            df = stream_to_dataframe(decoded, dimensions)
+        metrics.record_rows('build_dataframe', tabla_db, len(df))
+        total = int(df['M0'].sum())
+        store_table(df, item)
+        content_hashes[item['tabla']] = (content_hash, total)
+        return df, total
+
+    def derive(item):
+        source_df = dataframes[item['derived_from']]
+        if source_df is None:
+            # la tabla origen no ha cambiado, así que la derivada tampoco
+            metrics.record_skipped(item['tabla'] + suffix)
+            return None, totals[item['derived_from']]
+
+        if truncated(source_df):
+            # agregar un cubo incompleto daría totales por debajo de los reales
+            logging.warning(f"{item['derived_from']}{suffix} ({stats_date}): {len(source_df)} rows reach "
+                            f"the query window, fetching {item['tabla']}{suffix} directly")
+            return load(item, direct=True)
 
-        # Transformar los datos para obtener un pandas que poder guardar en una base de datos
-        df = convert_to_dataframe(columns, dm0_data, dimensions)
+        dimensions = item['dimensions']
+        with metrics.stage('rollup', item['tabla'] + suffix):
+            df = rollup_dataframe(source_df,
+                                  [columns_by_dimension[dim] for dim in dimensions],
+                                  dimensions)
+        store_table(df, item)
+        return df, int(df['M0'].sum())
+
+    def timed(work):
+        def run(item):
+            start = time.monotonic()
+            df, total = work(item)
+            return df, total, time.monotonic() - start
+        return run
+
+    timings = []
+    # lanza las queries de cada dimensión en paralelo, hasta `concurrency` a la vez
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for items, work in ((fetched_items, load), (derived_items, derive)):
+            for item, (df, total, seconds) in zip(items, executor.map(timed(work), items)):
+                dataframes[item['tabla']] = df
+                totals[item['tabla']] = total
+                timings.append({'table': item['tabla'] + suffix, 'period': stats_date,
+                                'seconds': round(seconds, 3), 'pilgrims': total, 'skipped': df is None})
+
+    if RESPONSE_CACHE_ENABLED:
+        for tabla, (content_hash, total) in content_hashes.items():
+            dependents = [item['tabla'] for item in derived_items if item['derived_from'] == tabla]
+            # con un cubo cortado las derivadas se piden aparte y pueden cambiar
+            # aunque él no cambie; si falló alguna escritura, la próxima carga
+            # debe repetirla en lugar de omitirla
+            if dependents and truncated(dataframes[tabla]):
+                continue
+            if all(name in stored_tables for name in [tabla] + dependents):
+                response_cache.set_entry(tabla + suffix, stats_date, content_hash, total)
+
+    if report is not None:
+        skipped = sum(1 for df in dataframes.values() if df is None)
+        report['skipped'] = report.get('skipped', 0) + skipped
+        report.setdefault('tables', []).extend(timings)
+
+    return totals
+
+
+def store_last_day(df, tabla_db, date):
+    # Pasar directamente a base de datos, publicando la tabla completa de
+    # golpe si así está configurado
+    if LAST_DAY_PUBLISH_MODE == 'swap':
+        return publish_data_into_db(df, tabla_db, date)
+    return insert_data_into_db(df, tabla_db, date)
+
+
+def update_stats_last_day(query_last_day, query_year_month, concurrency=PBI_CONCURRENCY, report=None):
 
-        # Pasar directamente a base de datos
-        insert_data_into_db(df, tabla_db, info_last_day['date'])
+    response_data = fetch_data_day(query_last_day)
+    info_last_day = extract_date_last_day(response_data)
 
-        # Limpieza de variables
-        dimensions = None
-        tabla_db = None
-        query_pbi = None
-        response_data = None
-        columns = None
-        dm0_data = None
-        df = None
+    # guarda la respuesta en la db
+    insert_data_into_db_last_day(info_last_day)
 
-        # espera 1s antes de seguir con el bucle
-        time.sleep(1)
+    # ajusto la plantilla con cada una de las queries
+    load_tables(query_year_month,
+                lambda dimensions: adjust_query_bytes(query_year_month, dimensions),
+                'last_day', info_last_day['date'], store_last_day, concurrency, report)
 
+    logging.info(f"HTTP transport: {transport.transport_stats()}")
     return info_last_day['pilgrims']
 
 
-def update_stats_year_month(query_year_month, start_year=2003, incremental=True):
+def update_stats_year_month(query_year_month, start_year=2003, incremental=True, report=None):
 
     # Mapeo de nombres de meses en inglés a español
     month_map = {
@@ -100,6 +263,15 @@ def update_stats_year_month(query_year_month, start_year=2003, incremental=True)
     # Convierte a español
     current_month = month_map[current_month_english.lower().capitalize()]
 
+    # La carga histórica completa la hace el motor de backfill, que guarda el
+    # progreso y puede reanudarse
+    if not incremental:
+        from backfill import run_backfill
+        summary = run_backfill(query_year_month, start_year)
+        if report is not None:
+            report['backfill'] = summary
+        return summary['pilgrims']
+
     # Definir el rango de fechas a iterar
     if incremental:
         years = [current_year]
@@ -110,26 +282,6 @@ def update_stats_year_month(query_year_month, start_year=2003, incremental=True)
         months = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio',
                   'julio', 'agosto', 'septiembre', 'octubre', 'noviembre', 'diciembre']
 
-    # Calcula el número total de conexiones requeridas
-    total_connections = 0
-    for year in years:
-        if year == current_year:
-            total_connections += len(months[:months.index(
-                current_month) + 1]) * len(queries_tables)
-        else:
-            total_connections += len(months) * len(queries_tables)
-
-    # Calcula el tiempo de espera para no exceder las 500 conexiones por hora
-    if incremental:
-        if total_connections <= 500:
-            wait_time = 3600 / 500
-        else:
-            wait_time = 3600 / total_connections
-    else:
-        wait_time = 1
-
-    wait_time = math.ceil(wait_time)
-
     # Variable para almacenar el último valor de df['M0'].sum()
     last_value = None
 
@@ -141,71 +293,67 @@ def update_stats_year_month(query_year_month, start_year=2003, incremental=True)
             months_to_iterate = months  # Todos los meses
 
         for month in months_to_iterate:
-            for item in queries_tables:
-                dimensions = item['dimensions']
-                tabla_db = item['tabla'] + 'monthly'
-
-                # Carga y ajusta la plantilla de consulta
-                query_pbi = adjust_query(
-                    query_year_month, dimensions, year, month)
-
-                # Obtiene y procesa los datos
-                response_data = fetch_data_day(query_pbi)
-                columns, dm0_data = extract(response_data)
+            # Inserta los datos en la base de datos
+            # primero hay que construir la fecha de las estadisticas en función del año y del mes del buclo
+            stats_date = datetime(
+                year, month_number_map[month], 1).strftime('%Y-%m-%d')
+
+            # Carga y ajusta la plantilla de consulta, obtiene y procesa los datos
+            totals = load_tables(
+                query_year_month,
+                lambda dimensions: adjust_query_bytes(query_year_month, dimensions, year, month),
+                'monthly', stats_date, partial(insert_data_into_db, incremental=incremental),
+                report=report)
 
-                df = convert_to_dataframe(columns, dm0_data, dimensions)
-                # Almacenar el último valor de df['M0'].sum()
-                last_value = df['M0'].sum()
-
-                # Inserta los datos en la base de datos
-                # primero hay que construir la fecha de las estadisticas en función del año y del mes del buclo
-
-                current_month_number = month_number_map[current_month]
-                stats_date = datetime(
-                    year, month_number_map[month], 1).strftime('%Y-%m-%d')
-
-                insert_data_into_db(df, tabla_db, stats_date, incremental)
-
-                # Limpieza de variables
-                dimensions = None
-                tabla_db = None
-                query_pbi = None
-                response_data = None
-                columns = None
-                dm0_data = None
-                df = None
-
-                # Espera 2 segundos antes de la próxima iteración
-                time.sleep(wait_time)
+            # Almacenar el último valor de df['M0'].sum()
+            last_value = totals[queries_tables[-1]['tabla']]
 
+    logging.info(f"HTTP transport: {transport.transport_stats()}")
     return int(last_value)
 
 
-def update_stats_date(query_date, dates):
+def fetch_dates(query_date, dates):
+    # Una petición por tabla para todas las fechas del lote, separada luego por
+    # fecha: devuelve {fecha: {tabla: df}}. Si la respuesta llena la ventana de
+    # filas de la consulta puede venir truncada y esa tabla se pide día a día
+    fetched_items, _ = split_derived(queries_tables)
+    frames = {date: {} for date in dates}
 
-    # Calcula el número total de conexiones requeridas
-    total_connections = len(dates)
+    for item in fetched_items:
+        dimensions = item['dimensions']
+        tabla_db = item['tabla'] + 'last_day'
+        query = build_query_dates(query_date, dimensions, dates)
+        period = f"{raw_archive.date_to_period(dates[0])}..{raw_archive.date_to_period(dates[-1])}"
+        df = decode_stream(raw_archive.archive_events(fetch_events(query), tabla_db, period, dates),
+                           dimensions)
+
+        window = query_window(query)
+        if window is not None and len(df) >= window:
+            logging.warning(f"{item['tabla']}: {len(df)} rows for {len(dates)} dates reach the "
+                            f"query window, fetching each date separately")
+            by_date = {date: decode_stream(raw_archive.archive_events(
+                                fetch_events(adjust_query_per_day_bytes(query_date, dimensions, date)),
+                                tabla_db, raw_archive.date_to_period(date)), dimensions)
+                       for date in dates}
+        else:
+            by_date = split_by_date(df, dates, dimensions)
 
-    wait_time = 1  # 1s - calcular cuando haya muchas fechas
+        for date, date_df in by_date.items():
+            frames[date][item['tabla']] = date_df
 
-    sum_values = []  # Variable para almacenar el valor de df['M0'].sum() para cada fecha
+    return frames
 
-    for date in dates:
-        for item in queries_tables:
-            dimensions = item['dimensions']
-            tabla_db = item['tabla'] + 'last_day'
 
-            # Carga y ajusta la plantilla de consulta
-            query_pbi = adjust_query_per_day(query_date, dimensions, date)
+def update_stats_date(query_date, dates, report=None, dates_per_query=PBI_DATES_PER_QUERY):
 
-            # Obtiene y procesa los datos
-            response_data = fetch_data_day(query_pbi)
-            columns, dm0_data = extract(response_data)
+    sum_values = []  # Variable para almacenar el valor de df['M0'].sum() para cada fecha
 
-            df = convert_to_dataframe(columns, dm0_data, dimensions)
-            # Almacenar el último valor de df['M0'].sum()
-            date_sum = int(df['M0'].sum())
+    for start in range(0, len(dates), dates_per_query):
+        batch = dates[start:start + dates_per_query]
+        # con varias fechas se piden todas de una vez y se reparten por día
+        frames = fetch_dates(query_date, batch) if len(batch) > 1 else None
 
+        for date in batch:
             # cambiar el formato de la fecha para guardarlo en base de datos
             # Convert the string to a datetime object using strptime
             date_obj = datetime.strptime(date, "%d/%m/%Y")
@@ -213,21 +361,18 @@ def update_stats_date(query_date, dates):
             # Convert the datetime object back to a string in "YYYY-MM-dd" format using strftime
             new_date_str = date_obj.strftime("%Y-%m-%d")
 
-            insert_data_into_db(df, tabla_db, new_date_str)
+            # Carga y ajusta la plantilla de consulta, obtiene y procesa los datos
+            totals = load_tables(
+                query_date,
+                lambda dimensions: adjust_query_per_day_bytes(query_date, dimensions, date),
+                'last_day', new_date_str, insert_data_into_db, report=report,
+                prefetched=frames[date] if frames is not None else None)
 
-            # Limpieza de variables
-            dimensions = None
-            tabla_db = None
-            query_pbi = None
-            response_data = None
-            columns = None
-            dm0_data = None
-            df = None
-
-            # Espera x segundos antes de la próxima iteración
-            time.sleep(wait_time)
-        sum_values.append(date_sum)
+            # Almacenar el último valor de df['M0'].sum()
+            date_sum = totals[queries_tables[-1]['tabla']]
+            sum_values.append(date_sum)
 
+    logging.info(f"HTTP transport: {transport.transport_stats()}")
     return sum_values
 
 
@@ -254,8 +399,9 @@ def get_pilgrims_now():
     """
 
     try:
-        response = requests.get(URL_OP_WEBSITE)
-        response.raise_for_status()  # Check if the request was successful
+        with metrics.stage('website'):
+            response = transport.get(URL_OP_WEBSITE)
+            response.raise_for_status()  # Check if the request was successful
     except requests.RequestException as e:
         logging.error(f"An error occurred: {e}")
         return None
@@ -280,23 +426,26 @@ def log_pilgrims_count():
         logging.error("Failed to retrieve pilgrims count.")
         return None
 
-    # Connect to the database
-    connection = connect_to_db()
-
-    # Insert the data into the database or update if the date already exists
-    date = datetime.now().strftime('%Y-%m-%d')
-    try:
-        with connection.cursor() as cursor:
-            sql_query = f"""
-                INSERT INTO {tabla_pilgrims_last_day} (date, pilgrims)
-                VALUES (%s, %s)
-                ON DUPLICATE KEY UPDATE pilgrims = VALUES(pilgrims);
-            """
-            cursor.execute(sql_query, (date, pilgrims_count))
-        connection.commit()
-    except pymysql.MySQLError as e:
-        logging.error(f"Error inserting or updating data in the database: {e}")
-        return None
-    finally:
-        connection.close()
-        return pilgrims_count, date
+    # Take a connection from the pool
+    with db_connection() as connection:
+        if connection is None:
+            logging.error("Failed to establish a connection.")
+            return None
+
+        # Insert the data into the database or update if the date already exists
+        date = datetime.now().strftime('%Y-%m-%d')
+        try:
+            with connection.cursor() as cursor:
+                sql_query = f"""
+                    INSERT INTO {tabla_pilgrims_last_day} (date, pilgrims)
+                    VALUES (%s, %s)
+                    ON DUPLICATE KEY UPDATE pilgrims = VALUES(pilgrims);
+                """
+                cursor.execute(sql_query, (date, pilgrims_count))
+            connection.commit()
+            read_cache.invalidate(tabla_pilgrims_last_day)
+        except pymysql.MySQLError as e:
+            logging.error(f"Error inserting or updating data in the database: {e}")
+            return None
+
+    return pilgrims_count, date
@@ -2,6 +2,9 @@ import pandas as pd
 import json
 import time
 import copy
+import re
+import ijson
+from datetime import datetime, timezone
 
 
 # Función para extraer los datos de la respuesta.
@@ -101,10 +104,213 @@ def convert_to_dataframe(columns, dm0_data, dims):
     return df
 
 
+
+# Decodificador columnar: convierte las filas DM0 directamente en columnas y
+# construye el DataFrame de una sola vez. Produce el mismo resultado que
+# extract + convert_to_dataframe sin modificar la respuesta original.
+
+def select_columns(descriptor_select):
+    return [item["GroupKeys"][0]["Source"]["Property"] if item["Kind"] == 1 else item["Value"]
+            for item in descriptor_select]
+
+
+def match_columns(descriptor_select, columns_types):
+    # Nombre de cada columna de DM0 en el orden de "S", que lista las
+    # agrupaciones (G0, G1...) antes que las medidas (M0) aunque el Select de
+    # la consulta las tenga en otro orden: se emparejan por el "Value" del
+    # descriptor y el "N" de cada columna, y si falta alguno, por posición
+    names = dict(zip((item["Value"] for item in descriptor_select), select_columns(descriptor_select)))
+    if all(column_type.get("N") in names for column_type in columns_types):
+        return [names[column_type["N"]] for column_type in columns_types]
+    return select_columns(descriptor_select)
+
+
+def decode_rows(dm0):
+    # Aplica los bitsets "R" (copiar el valor anterior) y "Ø" (valor nulo)
+    # mientras recorre las filas, sin insertar elemento a elemento en listas
+    columns_types = []
+    rows = []
+    prev_values = None
+    width = 0
+    for row in dm0:
+        if not rows:
+            columns_types = row["S"]
+            width = len(columns_types)
+        values = row.get("C", [])
+        copy_bitset = row.get("R", 0)
+        delete_bitset = row.get("Ø", 0)
+        if copy_bitset or delete_bitset:
+            remaining = iter(values)
+            values = [prev_values[i] if (copy_bitset >> i) & 1
+                      else None if (delete_bitset >> i) & 1
+                      else next(remaining)
+                      for i in range(width)]
+        rows.append(values)
+        prev_values = values
+
+    # Transpone las filas a una lista por columna
+    columns_data = [list(column) for column in zip(*rows)]
+    return columns_types, columns_data
+
+
+def build_dataframe(descriptor_select, columns_types, columns_data, value_dicts, dims):
+    if not columns_data:
+        return convert_to_dataframe([], [], dims)
+
+    frame = {}
+    for column, column_type, values in zip(match_columns(descriptor_select, columns_types),
+                                           columns_types, columns_data):
+        # Sustituye los índices por los valores de su ValueDict
+        if "DN" in column_type:
+            value_dict = value_dicts.get(column_type["DN"])
+            if value_dict is not None:
+                values = [value_dict[value] if isinstance(value, int) else value
+                          for value in values]
+
+        # Elimina saltos de línea y rellena los valores vacíos con "N/A"
+        values = [value.replace("\n", "") if isinstance(value, str)
+                  else "N/A" if value is None else value
+                  for value in values]
+
+        if column == 'M0':
+            # Elimina 'L' de la columna 'M0' y convierte a entero
+            frame[column] = pd.Series([int(value.replace('L', '')) for value in values],
+                                      dtype='int64')
+        else:
+            frame[column] = pd.Series(values, dtype=object)
+
+    # mismo orden de columnas que el descriptor, como en extract
+    return pd.DataFrame(frame, columns=select_columns(descriptor_select))
+
+
+def decode_to_dataframe(input_json, dims):
+    data = input_json["results"][0]["result"]["data"]
+    ds = data["dsr"]["DS"][0]
+    dm0 = ds["PH"][0]["DM0"]
+    if len(dm0) == 0:
+        return convert_to_dataframe([], [], dims)
+
+    columns_types, columns_data = decode_rows(dm0)
+    return build_dataframe(data["descriptor"]["Select"], columns_types, columns_data,
+                           ds.get("ValueDicts", {}), dims)
+
+
+
+# Lectura incremental de la respuesta de PBI: en lugar de cargar todo el json
+# en memoria se emiten las filas DM0, el descriptor y los ValueDicts según se
+# van leyendo del stream. Solo se consideran el primer DS y el primer PH, igual
+# que en extract.
+
+STREAM_DM0_PREFIX = 'results.item.result.data.dsr.DS.item.PH.item.DM0'
+STREAM_PREFIXES = {
+    'results.item.result.data.descriptor': 'descriptor',
+    STREAM_DM0_PREFIX + '.item': 'row',
+    'results.item.result.data.dsr.DS.item.ValueDicts': 'value_dicts',
+    'error': 'error',
+}
+
+
+def stream_dsr(fileobj):
+    completed = set()
+    builder = None
+    target = None
+    kind = None
+    for prefix, event, value in ijson.parse(fileobj, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == target and event in ('end_map', 'end_array'):
+                yield kind, builder.value
+                if kind != 'row':
+                    completed.add(kind)
+                builder = None
+            continue
+
+        if prefix == STREAM_DM0_PREFIX and event == 'end_array':
+            completed.add('row')
+            continue
+
+        kind = STREAM_PREFIXES.get(prefix)
+        if kind is not None and kind not in completed and event in ('start_map', 'start_array'):
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            target = prefix
+
+
+def dsr_events(input_json):
+    # Emite los mismos eventos que stream_dsr a partir de una respuesta ya cargada
+    data = input_json["results"][0]["result"]["data"]
+    ds = data["dsr"]["DS"][0]
+    yield 'descriptor', data["descriptor"]
+    for row in ds["PH"][0]["DM0"]:
+        yield 'row', row
+    if "ValueDicts" in ds:
+        yield 'value_dicts', ds["ValueDicts"]
+
+
+def read_stream(events, digest=None):
+    # Reconstruye las columnas a partir de los eventos. Si se pasa `digest`
+    # (un objeto de hashlib) se va calculando el hash del contenido, que no
+    # depende del jobId ni del orden en que lleguen descriptor y ValueDicts
+    parts = {}
+
+    def rows():
+        for kind, value in events:
+            if kind == 'row':
+                if digest is not None:
+                    digest.update(json.dumps(value, sort_keys=True).encode())
+                yield value
+            else:
+                parts[kind] = value
+
+    columns_types, columns_data = decode_rows(rows())
+    # un cuerpo de error (a veces con HTTP 200) no trae descriptor ni filas:
+    # debe fallar como en extract y no pasar por un resultado vacío
+    if 'error' in parts or ('descriptor' not in parts and not columns_data):
+        raise ValueError(f"Power BI response has no result data: {json.dumps(parts.get('error'))[:500]}")
+    if digest is not None:
+        digest.update(json.dumps(parts, sort_keys=True).encode())
+    return columns_types, columns_data, parts
+
+
+def stream_to_dataframe(decoded, dims):
+    columns_types, columns_data, parts = decoded
+    if not columns_data:
+        return convert_to_dataframe([], [], dims)
+
+    return build_dataframe(parts['descriptor']['Select'], columns_types, columns_data,
+                           parts.get('value_dicts', {}), dims)
+
+
+def decode_stream(events, dims):
+    # Equivalente a decode_to_dataframe a partir de los eventos de stream_dsr
+    return stream_to_dataframe(read_stream(events), dims)
+
+
+# Agregación local de cubos: permite obtener las tablas de una dimensión a
+# partir de la respuesta de una query con varias dimensiones
+
+def dimension_columns(json_payload):
+    # Relaciona cada dimensión de la plantilla (d1, d2...) con el nombre de la
+    # columna que tendrá en el DataFrame
+    if isinstance(json_payload, str):
+        json_payload = json.loads(json_payload)
+    select_section = json_payload['queries'][0]['Query']['Commands'][0]['SemanticQueryDataShapeCommand']['Query']['Select']
+    return {entry['Column']['Expression']['SourceRef']['Source']: entry['Column']['Property']
+            for entry in select_section if 'Column' in entry}
+
+
+def rollup_dataframe(df, columns, dims):
+    # Suma M0 agrupando por las columnas indicadas. Un cubo vacío (sin esas
+    # columnas) da el mismo DataFrame vacío que una query sin resultados
+    if any(column not in df.columns for column in columns):
+        return convert_to_dataframe([], [], dims)
+    return df.groupby(columns, sort=False, dropna=False)['M0'].sum().reset_index()
+
+
 # Función para adaptar una query_template en función de las dimensiones que se
 # quieren consultar a PBI para luego guardar
 
-def adjust_query(json_payload, dimensions, year=None, month=None):
+def build_query(json_payload, dimensions, year=None, month=None):
 
     # Convertir la cadena JSON en un objeto dict de Python
     if isinstance(json_payload, str):
@@ -186,7 +392,7 @@ def adjust_query(json_payload, dimensions, year=None, month=None):
     return payload
 
 
-def adjust_query_per_day(json_payload, dimensions, date):
+def build_query_per_day(json_payload, dimensions, date):
     # Función para adaptar una query_template en función de las dimensiones que se
     # quieren consultar a PBI para luego guardar
 
@@ -248,6 +454,141 @@ def adjust_query_per_day(json_payload, dimensions, date):
     return payload
 
 
+# Plantillas precompiladas: build_query y build_query_per_day solo se
+# ejecutan una vez por plantilla y combinación de dimensiones, con marcas en
+# lugar de los literales de Año/Mes/Date. El resultado se guarda serializado
+# y partido por esas marcas, así que cada petición solo tiene que unir bytes.
+
+QUERY_SLOTS = {'year': '@@year@@', 'month': '@@month@@', 'date': '@@date@@'}
+QUERY_SLOT_PATTERN = re.compile('(' + '|'.join(QUERY_SLOTS.values()) + ')')
+COMPILED_QUERIES_MAX = 256
+
+compiled_queries = {}
+
+
+def compile_query(json_payload, key, build):
+    # Las plantillas en texto se identifican por su contenido y los dict por
+    # identidad (se guarda una referencia para que el id no se reutilice)
+    cache_key = (json_payload if isinstance(json_payload, str) else id(json_payload),) + key
+    entry = compiled_queries.get(cache_key)
+    if entry is None or (entry[0] is not json_payload and not isinstance(json_payload, str)):
+        serialized = json.dumps(build(json_payload))
+        slot_names = {marker: name for name, marker in QUERY_SLOTS.items()}
+        chunks = [slot_names.get(part, part.encode())
+                  for part in QUERY_SLOT_PATTERN.split(serialized)]
+        if len(compiled_queries) >= COMPILED_QUERIES_MAX:
+            compiled_queries.clear()
+        entry = (json_payload, chunks)
+        compiled_queries[cache_key] = entry
+    return entry[1]
+
+
+def render_query(chunks, **values):
+    # Sustituye las marcas por los valores escapados como cadenas JSON
+    encoded = {name: json.dumps(str(value))[1:-1].encode() for name, value in values.items()}
+    return b''.join(encoded[chunk] if isinstance(chunk, str) else chunk for chunk in chunks)
+
+
+def adjust_query_bytes(json_payload, dimensions, year=None, month=None):
+    chunks = compile_query(
+        json_payload, ('year_month', tuple(dimensions), year is not None, month is not None),
+        lambda payload: build_query(payload, dimensions,
+                                    QUERY_SLOTS['year'] if year is not None else None,
+                                    QUERY_SLOTS['month'] if month is not None else None))
+    values = {}
+    if year is not None:
+        values['year'] = year
+    if month is not None:
+        values['month'] = month
+    return render_query(chunks, **values)
+
+
+def adjust_query_per_day_bytes(json_payload, dimensions, date):
+    chunks = compile_query(
+        json_payload, ('date', tuple(dimensions)),
+        lambda payload: build_query_per_day(payload, dimensions, QUERY_SLOTS['date']))
+    return render_query(chunks, date=date)
+
+
+# Consultas de varios días: todas las fechas van en el filtro 'In' de Date y
+# la fecha se añade como agrupación, de modo que una sola petición por tabla
+# trae todos los días y el resultado se separa localmente.
+
+DATE_PROPERTY = 'Date'
+
+
+def build_query_dates(json_payload, dimensions, dates):
+    payload = build_query_per_day(json_payload, dimensions, dates[0])
+    command = payload['queries'][0]['Query']['Commands'][0]['SemanticQueryDataShapeCommand']
+    query = command['Query']
+
+    date_column = None
+    for condition in query.get('Where', []):
+        if 'Condition' in condition and 'In' in condition['Condition']:
+            expression = condition['Condition']['In']['Expressions'][0]
+            if expression.get('Column', {}).get('Property', "") == DATE_PROPERTY:
+                condition['Condition']['In']['Values'] = [
+                    [{'Literal': {'Value': f"'{date}'"}}] for date in dates]
+                date_column = copy.deepcopy(expression['Column'])
+
+    if date_column is None:
+        raise ValueError("The query template has no Date filter")
+
+    # Date como agrupación adicional, detrás de las demás columnas y delante
+    # de la medida: es el orden en que PBI devuelve las columnas de DM0
+    # (agrupaciones y luego medidas), y al quitarla quedan las mismas columnas
+    # que en la consulta de un solo día
+    source = date_column['Expression']['SourceRef']['Source']
+    entity = next((entry['Entity'] for entry in query['From'] if entry['Name'] == source), source)
+    position = next((index for index, entry in enumerate(query['Select']) if 'Measure' in entry),
+                    len(query['Select']))
+    query['Select'].insert(position, {'Column': date_column, 'Name': f"{entity}.{DATE_PROPERTY}"})
+    command['Binding']['Primary']['Groupings'][0]['Projections'] = list(range(len(query['Select'])))
+
+    return payload
+
+
+def query_window(payload):
+    # Número máximo de filas que devuelve PBI para la consulta, si lo indica
+    if isinstance(payload, (str, bytes)):
+        payload = json.loads(payload)
+    command = payload['queries'][0]['Query']['Commands'][0]['SemanticQueryDataShapeCommand']
+    return command.get('Binding', {}).get('DataReduction', {}).get('Primary', {}).get('Window', {}).get('Count')
+
+
+def format_date_value(value):
+    # PBI devuelve las fechas como milisegundos desde epoch (UTC) o como texto
+    # ISO; se pasan al formato dd/mm/YYYY de las fechas de la consulta
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value[:10]).strftime('%d/%m/%Y')
+        except ValueError:
+            if not value.lstrip('-').isdigit():
+                return value
+            value = int(value)
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc).strftime('%d/%m/%Y')
+
+
+def split_by_date(df, dates, dims):
+    # Devuelve {fecha: DataFrame sin la columna Date}; las fechas sin filas
+    # reciben el mismo DataFrame vacío que una consulta de un solo día
+    frames = {}
+    if DATE_PROPERTY in df.columns:
+        keys = df[DATE_PROPERTY].map(format_date_value)
+        for date, group in df.drop(columns=DATE_PROPERTY).groupby(keys, sort=False):
+            frames[date] = group.reset_index(drop=True)
+    return {date: frames[date] if date in frames else convert_to_dataframe([], [], dims)
+            for date in dates}
+
+
+def adjust_query(json_payload, dimensions, year=None, month=None):
+    return json.loads(adjust_query_bytes(json_payload, dimensions, year, month))
+
+
+def adjust_query_per_day(json_payload, dimensions, date):
+    return json.loads(adjust_query_per_day_bytes(json_payload, dimensions, date))
+
+
 def extract_date_last_day(json_data):
     # Initialize an empty dictionary to store the extracted data
     data_dict = {}
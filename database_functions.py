@@ -3,9 +3,14 @@ import pandas as pd
 from datetime import datetime
 import time
 import json
+import hashlib
 import logging
+import threading
+from contextlib import contextmanager
 
 from config import *  # Importing configurations
+from db_pool import ConnectionPool
+import read_cache
 
 # conexión a la base de datos desde el exterior de Hostinger
 def connect_to_db():
@@ -20,127 +25,379 @@ def connect_to_db():
         print(f"Error connecting to the database: {e}")
         return None
 
+
+# Pool de conexiones compartido por todas las funciones de este módulo
+db_pool = ConnectionPool(connect_to_db,
+                         max_size=DB_POOL_SIZE,
+                         max_lifetime=DB_POOL_MAX_LIFETIME,
+                         health_check_interval=DB_POOL_HEALTH_CHECK,
+                         timeout=DB_POOL_TIMEOUT)
+
+
+@contextmanager
+def db_connection():
+    # Presta una conexión del pool (o None si no se pudo conectar) y la devuelve al salir
+    connection = db_pool.acquire()
+    discard = False
+    try:
+        yield connection
+    except pymysql.OperationalError:
+        discard = True
+        raise
+    finally:
+        if connection is not None:
+            db_pool.release(connection, discard)
+
+# Caché de metadatos de las tablas destino, indexada por nombre de tabla:
+# columnas (DESCRIBE), columnas de la clave primaria y la sentencia
+# INSERT ... ON DUPLICATE KEY UPDATE ya construida
+table_schemas = {}
+
+
+def build_insert_query(table, columns):
+    all_columns = ', '.join(columns)
+    update_columns = ', '.join([f"{col}=VALUES({col})" for col in columns])
+    placeholders = ', '.join(['%s'] * len(columns))
+    return f"INSERT INTO {table} ({all_columns}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {update_columns}"
+
+
+def get_table_schema(cursor, table):
+    # Solo consulta DESCRIBE la primera vez que se usa la tabla
+    schema = table_schemas.get(table)
+    if schema is None:
+        cursor.execute(f"DESCRIBE {table};")
+        described = cursor.fetchall()
+        columns = [column[0] for column in described]
+        schema = {'columns': columns,
+                  'key_columns': [column[0] for column in described if column[3] == 'PRI'],
+                  'insert_query': build_insert_query(table, columns)}
+        table_schemas[table] = schema
+    return schema
+
+
+def invalidate_table_schema(table=None):
+    # Olvida el esquema de una tabla (o de todas) tras un cambio de estructura
+    if table is None:
+        table_schemas.clear()
+    else:
+        table_schemas.pop(table, None)
+
+
+def create_daily_totals_table():
+    # Se llama una vez al arrancar: crea la tabla de resumen y la rellena con
+    # los totales de las tablas que todavía no tienen ninguno, así la primera
+    # carga tras el despliegue no deja una única fecha (quizá antigua) en el
+    # resumen. Devuelve la lista de problemas encontrados
+    problems = []
+    with db_connection() as connection:
+        if connection is None:
+            return ["Failed to establish a connection."]
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"""CREATE TABLE IF NOT EXISTS {tabla_daily_totals} (
+                                  tabla VARCHAR(64) NOT NULL,
+                                  date DATE NOT NULL,
+                                  total BIGINT NOT NULL,
+                                  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                                  PRIMARY KEY (tabla, date))""")
+            for table in sorted(stats_tables()):
+                try:
+                    cursor.execute(f"SELECT 1 FROM {tabla_daily_totals} WHERE tabla = %s LIMIT 1", (table,))
+                    if cursor.fetchone():
+                        continue
+                    schema = get_table_schema(cursor, table)
+                    cursor.execute(
+                        f"""INSERT IGNORE INTO {tabla_daily_totals} (tabla, date, total)
+                            SELECT %s, date, SUM({schema['columns'][-1]})
+                            FROM {table} GROUP BY date""",
+                        (table,))
+                    connection.commit()
+                except pymysql.MySQLError as e:
+                    connection.rollback()
+                    problems.append(f"{tabla_daily_totals} ({table}): {e}")
+        except pymysql.MySQLError as e:
+            problems.append(f"{tabla_daily_totals}: {e}")
+        finally:
+            cursor.close()
+    return problems
+
+
+def update_daily_total(connection, cursor, table, schema, date_to_insert):
+    # Recalcula el total de la fecha una vez confirmada la carga. Es opcional:
+    # si falla (p. ej. la tabla de resumen no existe) la carga se conserva y
+    # la lectura de / lo detecta y suma la tabla. La última columna es la de
+    # peregrinos (el M0 del DataFrame)
+    try:
+        cursor.execute(
+            f"""INSERT INTO {tabla_daily_totals} (tabla, date, total)
+                SELECT %s, %s, COALESCE(SUM({schema['columns'][-1]}), 0)
+                FROM {table} WHERE date = %s
+                ON DUPLICATE KEY UPDATE total = VALUES(total)""",
+            (table, date_to_insert, date_to_insert))
+        connection.commit()
+    except pymysql.MySQLError as e:
+        logging.warning(f"Could not update {tabla_daily_totals} for {table} ({date_to_insert}): {e}")
+        connection.rollback()
+
+
+def check_table_schemas():
+    # Carga y comprueba el esquema de todas las tablas de queries_tables;
+    # devuelve la lista de problemas encontrados
+    problems = []
+    with db_connection() as connection:
+        if connection is None:
+            return ["Failed to establish a connection."]
+        cursor = connection.cursor()
+        try:
+            for item in queries_tables:
+                for suffix in ('last_day', 'monthly'):
+                    table = item['tabla'] + suffix
+                    invalidate_table_schema(table)
+                    try:
+                        schema = get_table_schema(cursor, table)
+                    except pymysql.MySQLError as e:
+                        problems.append(f"{table}: {e}")
+                        continue
+                    if 'date' not in schema['columns']:
+                        problems.append(f"{table}: missing 'date' column")
+                    elif len(schema['columns']) != len(item['dimensions']) + 2:
+                        problems.append(f"{table}: expected {len(item['dimensions']) + 2} columns, found {len(schema['columns'])}")
+        finally:
+            cursor.close()
+    return problems
+
+
+def dataframe_rows(df, date_to_insert):
+    # Construye las tuplas a insertar columna a columna, sin iterrows; tolist()
+    # devuelve tipos nativos de Python que pymysql escapa directamente
+    columns_data = [df[col].tolist() for col in df.columns]
+    return [(date_to_insert,) + row for row in zip(*columns_data)]
+
+
+def bulk_insert(connection, cursor, insert_query, rows,
+                batch_size=BULK_BATCH_SIZE, commit_every_batch=BULK_COMMIT_EVERY_BATCH):
+    # executemany agrupa cada lote en sentencias INSERT multi-fila de hasta
+    # max_stmt_length bytes
+    cursor.max_stmt_length = BULK_MAX_STATEMENT_BYTES
+    for start in range(0, len(rows), batch_size):
+        cursor.executemany(insert_query, rows[start:start + batch_size])
+        if commit_every_batch:
+            connection.commit()
+
+
+def _diff_key_columns(schema):
+    # Columnas que identifican una fila dentro de una fecha
+    return [column for column in schema['key_columns'] if column != 'date']
+
+
+def diff_rows(cursor, table, schema, rows, date_to_insert):
+    # Compara las filas nuevas con las guardadas para la fecha y devuelve las
+    # filas a insertar o actualizar y las claves que hay que borrar
+    columns = schema['columns']
+    key_columns = _diff_key_columns(schema)
+    key_indexes = [columns.index(column) for column in key_columns]
+    value_indexes = [index for index, column in enumerate(columns)
+                     if column not in schema['key_columns']]
+
+    cursor.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE date = %s", (date_to_insert,))
+    existing = {tuple(row[i] for i in key_indexes): tuple(str(row[i]) for i in value_indexes)
+                for row in cursor.fetchall()}
+
+    changed_rows = []
+    for row in rows:
+        key = tuple(row[i] for i in key_indexes)
+        current_values = existing.pop(key, None)
+        if current_values != tuple(str(row[i]) for i in value_indexes):
+            changed_rows.append(row)
+
+    # lo que queda en existing ya no está en la respuesta
+    return changed_rows, list(existing)
+
+
+def delete_rows(cursor, table, schema, keys, date_to_insert):
+    if not keys:
+        return
+    conditions = ' AND '.join(f"{column} = %s" for column in _diff_key_columns(schema))
+    cursor.executemany(f"DELETE FROM {table} WHERE date = %s AND {conditions}",
+                       [(date_to_insert,) + key for key in keys])
+
+
+@contextmanager
+def table_write_lock(cursor, table, timeout=TABLE_LOCK_TIMEOUT):
+    # Bloqueo con nombre de MySQL (GET_LOCK) que toman todas las escrituras de
+    # una tabla stats_*, sea cual sea el proceso que las hace
+    name = f"write_{table}"
+    cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+    if cursor.fetchone()[0] != 1:
+        raise RuntimeError(f"Could not acquire the write lock for {table}")
+    try:
+        yield
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+
+
 def insert_data_into_db(df, table, date_to_insert, incremental=False):
     max_retries = 3
     retries = 0
 
     while retries < max_retries:
-        connection = connect_to_db()
-        if connection:
-            break
+        with db_connection() as connection:
+            if connection:
+                return _insert_data(connection, df, table, date_to_insert, incremental)
         print(f"Retrying connection ({retries + 1}/{max_retries})")
         retries += 1
         time.sleep(5)  # Wait for 5 seconds before retrying
 
-    if connection is None:
-        print("Failed to establish a connection after several attempts.")
-        return
+    print("Failed to establish a connection after several attempts.")
 
+
+def _insert_data(connection, df, table, date_to_insert, incremental):
     cursor = connection.cursor()
     try:
-        # Obtiene los nombres de las columnas de la tabla destino
-        cursor.execute(f"DESCRIBE {table};")
-        columns = [column[0] for column in cursor.fetchall()]
-        
-        # Asegurarse de que 'date' está en la lista de columnas
-        if 'date' not in columns:
-            print(f"La tabla {table} debe tener una columna 'date'")
-            return
+        # el mismo bloqueo que publish_data_into_db: una publicación por
+        # tabla sombra no puede perder lo que se escriba mientras tanto
+        with table_write_lock(cursor, table):
+            # Obtiene los nombres de las columnas y la sentencia INSERT de la caché
+            schema = get_table_schema(cursor, table)
+            columns = schema['columns']
+            insert_query = schema['insert_query']
 
-        # Delete existing records if incremental is True
-        if incremental:
-            cursor.execute(f"DELETE FROM {table} WHERE date = %s", (date_to_insert,))
-            connection.commit()
-        
-        # inicializa los datos a insertar en la tabla
-        data_to_insert = []
+            # Asegurarse de que 'date' está en la lista de columnas
+            if 'date' not in columns:
+                print(f"La tabla {table} debe tener una columna 'date'")
+                return
 
-        for index, row in df.iterrows():
-            
-            row_data = [date_to_insert] + [row[col] for col in df.columns]
+            start = time.monotonic()
 
             # el numero de peregrinos siempre es mayor que cero porque la
             # query a PBI lo utiliza como filtro
-            data_to_insert.append(tuple(row_data))
-
-            if len(data_to_insert) >= 500:
-                all_columns = ', '.join(columns)
-                update_columns = ', '.join([f"{col}=VALUES({col})" for col in columns])
-                placeholders = ', '.join(['%s'] * len(row_data))
-                insert_query = f"INSERT INTO {table} ({all_columns}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {update_columns}"
-
-                cursor.executemany(insert_query, data_to_insert)
-                connection.commit()
-                data_to_insert = []
-
-        if len(data_to_insert) > 0:
-            all_columns = ', '.join(columns)
-            update_columns = ', '.join([f"{col}=VALUES({col})" for col in columns])
-            placeholders = ', '.join(['%s'] * len(row_data))
-            insert_query = f"INSERT INTO {table} ({all_columns}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {update_columns}"
-
-            cursor.executemany(insert_query, data_to_insert)
+            data_to_insert = dataframe_rows(df, date_to_insert)
+
+            if incremental and INCREMENTAL_MODE == 'diff' and schema['key_columns']:
+                # Solo se envían las filas nuevas o modificadas y se borran las que
+                # ya no existen, en la misma transacción
+                data_to_insert, removed_keys = diff_rows(cursor, table, schema, data_to_insert, date_to_insert)
+                delete_rows(cursor, table, schema, removed_keys, date_to_insert)
+            elif incremental:
+                # Delete existing records if incremental is True, in the same
+                # transaction as the new rows
+                cursor.execute(f"DELETE FROM {table} WHERE date = %s", (date_to_insert,))
+
+            bulk_insert(connection, cursor, insert_query, data_to_insert)
             connection.commit()
+            update_daily_total(connection, cursor, table, schema, date_to_insert)
+        read_cache.invalidate(table)
+
+        elapsed = time.monotonic() - start
+        rows_per_second = len(data_to_insert) / elapsed if elapsed > 0 else 0
+        logging.info(f"{table} ({date_to_insert}): {len(data_to_insert)} rows in {elapsed:.2f}s ({rows_per_second:.0f} rows/s)")
+        return {'rows': len(data_to_insert), 'seconds': elapsed, 'rows_per_second': rows_per_second}
 
     except Exception as e:
         print(f"Error during data insertion: {e}")
         connection.rollback()
+        # por si el error se debe a un cambio en la estructura de la tabla
+        invalidate_table_schema(table)
     finally:
         cursor.close()
-        connection.close()
+
+def publish_data_into_db(df, table, date_to_insert):
+    # Carga los datos en una tabla sombra y la intercambia con la original con
+    # RENAME TABLE, que es atómico: los lectores ven la tabla anterior o la
+    # nueva completa, nunca una carga a medias, y no compiten por sus bloqueos.
+    # La sombra se construye copiando toda la tabla, así que cada publicación
+    # cuesta lo mismo que el histórico completo (ver LAST_DAY_PUBLISH_MODE)
+    shadow_table = f"{table}_shadow"
+    old_table = f"{table}_old"
+
+    with db_connection() as connection:
+        if connection is None:
+            print("Failed to establish a connection.")
+            return
+
+        cursor = connection.cursor()
+        try:
+            # mientras se copia y se intercambia la tabla ninguna otra
+            # escritura puede tocarla, o se perdería al hacer el RENAME
+            with table_write_lock(cursor, table):
+                schema = get_table_schema(cursor, table)
+                start = time.monotonic()
+
+                # la sombra parte del contenido actual para conservar el histórico
+                cursor.execute(f"DROP TABLE IF EXISTS {shadow_table}")
+                cursor.execute(f"CREATE TABLE {shadow_table} LIKE {table}")
+                cursor.execute(f"INSERT INTO {shadow_table} SELECT * FROM {table}")
+
+                data_to_insert = dataframe_rows(df, date_to_insert)
+                bulk_insert(connection, cursor, build_insert_query(shadow_table, schema['columns']), data_to_insert)
+                connection.commit()
+
+                cursor.execute(f"DROP TABLE IF EXISTS {old_table}")
+                cursor.execute(f"RENAME TABLE {table} TO {old_table}, {shadow_table} TO {table}")
+                cursor.execute(f"DROP TABLE {old_table}")
+
+                # el resumen se actualiza cuando los datos ya están publicados:
+                # si el RENAME falla, / sigue mostrando el total de la tabla anterior
+                update_daily_total(connection, cursor, table, schema, date_to_insert)
+            read_cache.invalidate(table)
+
+            elapsed = time.monotonic() - start
+            logging.info(f"{table} ({date_to_insert}): published {len(data_to_insert)} rows in {elapsed:.2f}s")
+            return {'rows': len(data_to_insert), 'seconds': elapsed,
+                    'rows_per_second': len(data_to_insert) / elapsed if elapsed > 0 else 0}
+
+        except Exception as e:
+            print(f"Error publishing {table}: {e}")
+            connection.rollback()
+            invalidate_table_schema(table)
+        finally:
+            cursor.close()
+
 
 def insert_data_into_db_last_day(data_dict):
     # Guarda los datos de resumen de pilgrims sencillos
 
-    # Establish a connection to the MySQL database
-    connection = pymysql.connect(
-        host=db_config['host'],
-        user=db_config['user'],
-        password=db_config['password'],
-        database=db_config['database']
-    )
-    
-    try:
+    # Take a connection to the MySQL database from the pool
+    with db_connection() as connection:
+        if connection is None:
+            print("Failed to establish a connection.")
+            return
+
         # Create a cursor object
         cursor = connection.cursor()
-        
-        # SQL query to insert the data into the table
-        sql_query = """INSERT IGNORE INTO stats_pilgrims_last_day (date, pilgrims)
-                       VALUES (%s, %s)"""
-        
-        # Values to insert into the table
-        values = (data_dict.get('date', None), data_dict.get('pilgrims', None))
-        
-        # Execute the SQL query
-        cursor.execute(sql_query, values)
-        
-        # Commit the transaction
-        connection.commit()
-        
-    except pymysql.MySQLError as e:
-        print(f"An error occurred: {e}")
-        
-    finally:
-        # Close the database connection
-        connection.close()
+        try:
+            # SQL query to insert the data into the table
+            sql_query = f"""INSERT IGNORE INTO {tabla_pilgrims_last_day} (date, pilgrims)
+                           VALUES (%s, %s)"""
 
-def get_queries_from_db():
+            # Values to insert into the table
+            values = (data_dict.get('date', None), data_dict.get('pilgrims', None))
 
-    max_retries = 3
-    retries = 0
+            # Execute the SQL query
+            cursor.execute(sql_query, values)
 
-    while retries < max_retries:
-        connection = connect_to_db()
-        if connection:
-            break
-        logging.warning(f"Retrying connection ({retries + 1}/{max_retries})")
-        retries += 1
-        time.sleep(15)  # Wait for 15 seconds before retrying
+            # Commit the transaction
+            connection.commit()
+            read_cache.invalidate(tabla_pilgrims_last_day)
+
+        except pymysql.MySQLError as e:
+            print(f"An error occurred: {e}")
 
-    if connection is None:
-        logging.error("Failed to establish a connection after several attempts.")
-        return None, None, None
+        finally:
+            # Close the cursor, the connection goes back to the pool
+            cursor.close()
 
+def get_queries_checksum(connection):
+    # Huella del contenido de db_queries_stats, para saber si las plantillas
+    # han cambiado sin descargarlas enteras
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT template, MD5(query) FROM db_queries_stats ORDER BY template")
+        return hashlib.sha256(repr(cursor.fetchall()).encode()).hexdigest()
+    finally:
+        cursor.close()
+
+def read_queries(connection):
     cursor = connection.cursor()
 
     # Buscar en la tabla db_queries_stats
@@ -160,9 +417,8 @@ def get_queries_from_db():
         if row[0] == "query_template_all_columns_any_day":
             template_query_date = row[1]
 
-    # Cerrar cursor y conexión
+    # Cerrar cursor
     cursor.close()
-    connection.close()
 
     return json.loads(query_date_last_day), json.loads(template_query_year_month), json.loads(template_query_date)
 
@@ -171,67 +427,230 @@ def get_sum_pilgrims_last_day():
     This function reads data from the "db_caminos" table for the last recorded day
     and returns the sum of the "pilgrims" column.
     """
-    # Establish a connection to the database
-    connection = connect_to_db()
-    
-    if connection is None:
-        print("Failed to establish a connection.")
-        return None
+    # Take a connection from the pool
+    with db_connection() as connection:
 
-    cursor = connection.cursor()
+        if connection is None:
+            print("Failed to establish a connection.")
+            return None
+
+        cursor = connection.cursor()
 
-    # Step 1: Determine the last recorded date
-    cursor.execute(f"SELECT MAX(date) FROM {tabla_check};")
-    last_date = cursor.fetchone()[0]
-    if not last_date:
-        print("No records found in the table.")
+        # Step 1: Determine the last recorded date
+        cursor.execute(f"SELECT MAX(date) FROM {tabla_check};")
+        last_date = cursor.fetchone()[0]
+        if not last_date:
+            print("No records found in the table.")
+            cursor.close()
+            return None, None
+
+        # Lectura por clave primaria del resumen que mantienen las cargas; solo
+        # vale si es de la misma fecha que la tabla
+        total_pilgrims = get_daily_total(cursor, tabla_check, last_date)
+        if total_pilgrims is None:
+            # Step 2: Query the data for the last date and sum the "pilgrims" column
+            cursor.execute(f"SELECT SUM(pilgrims) FROM {tabla_check} WHERE date = %s;", (last_date,))
+            total_pilgrims = cursor.fetchone()[0]
+
+        # Close the cursor, the connection goes back to the pool
         cursor.close()
-        connection.close()
-        return None, None
-    last_date_str = last_date.strftime('%Y-%m-%d')
 
-    # Step 2: Query the data for the last date and sum the "pilgrims" column
-    sql_query = f"SELECT SUM(pilgrims) FROM {tabla_check} WHERE date = '{last_date_str}';"
-    cursor.execute(sql_query)
-    total_pilgrims = cursor.fetchone()[0]
+    # SUM devuelve Decimal, que Flask serializa como cadena
+    return last_date, int(total_pilgrims) if total_pilgrims is not None else None
 
-    # Close the cursor and the connection
-    cursor.close()
-    connection.close()
+def get_daily_total(cursor, table, date):
+    # Total de la fecha en daily_totals, o None si el resumen no la tiene (o
+    # no existe) y hay que sumar la tabla
+    try:
+        cursor.execute(f"SELECT total FROM {tabla_daily_totals} WHERE tabla = %s AND date = %s",
+                       (table, date))
+    except pymysql.err.ProgrammingError:
+        # la tabla de resumen aún no existe
+        return None
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_daily_totals(table=tabla_check, start_date=None, end_date=None):
+    """
+    Returns the daily totals of `table` between `start_date` and `end_date`
+    (both optional, 'YYYY-MM-DD') as a list of {"date", "total"} dicts in date
+    order, read from the daily_totals summary table.
+    """
+    with db_connection() as connection:
+
+        if connection is None:
+            print("Failed to establish a connection.")
+            return None
+
+        conditions = ["tabla = %s"]
+        values = [table]
+        if start_date:
+            conditions.append("date >= %s")
+            values.append(start_date)
+        if end_date:
+            conditions.append("date <= %s")
+            values.append(end_date)
+
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"SELECT date, total FROM {tabla_daily_totals} "
+                           f"WHERE {' AND '.join(conditions)} ORDER BY date", values)
+            rows = cursor.fetchall()
+        except pymysql.err.ProgrammingError:
+            rows = []
+        finally:
+            cursor.close()
+
+    return [{'date': date.strftime('%Y-%m-%d'), 'total': total} for date, total in rows]
 
-    return last_date, total_pilgrims
 
 def get_pilgrims_last_day():
     """
     This function reads data from the "db_caminos" table for the last recorded day
     and returns the sum of the "pilgrims" column.
     """
-    # Establish a connection to the database
-    connection = connect_to_db()
-    
-    if connection is None:
-        print("Failed to establish a connection.")
-        return None
+    # Take a connection from the pool
+    with db_connection() as connection:
 
-    cursor = connection.cursor()
+        if connection is None:
+            print("Failed to establish a connection.")
+            return None
+
+        cursor = connection.cursor()
 
-    # Step 1: Determine the last recorded date
-    cursor.execute(f"SELECT MAX(date) FROM {tabla_pilgrims_last_day};")
-    last_date = cursor.fetchone()[0]
-    if not last_date:
-        print("No records found in the table.")
+        # Step 1: Determine the last recorded date
+        cursor.execute(f"SELECT MAX(date) FROM {tabla_pilgrims_last_day};")
+        last_date = cursor.fetchone()[0]
+        if not last_date:
+            print("No records found in the table.")
+            cursor.close()
+            return None, None
+        last_date_str = last_date.strftime('%Y-%m-%d')
+
+        # Step 2: Query the data for the last date and sum the "pilgrims" column
+        sql_query = f"SELECT pilgrims FROM {tabla_pilgrims_last_day} WHERE date = '{last_date_str}';"
+        cursor.execute(sql_query)
+        total_pilgrims = cursor.fetchone()[0]
+
+        # Close the cursor, the connection goes back to the pool
         cursor.close()
-        connection.close()
-        return None, None
-    last_date_str = last_date.strftime('%Y-%m-%d')
 
-    # Step 2: Query the data for the last date and sum the "pilgrims" column
-    sql_query = f"SELECT pilgrims FROM {tabla_pilgrims_last_day} WHERE date = '{last_date_str}';"
-    cursor.execute(sql_query)
-    total_pilgrims = cursor.fetchone()[0]
+    return last_date_str, total_pilgrims
 
-    # Close the cursor and the connection
-    cursor.close()
-    connection.close()
+# Lectura paginada de las tablas stats_*: las consultas se construyen solo con
+# nombres de columna validados contra el esquema, paginación por clave
+# (keyset) en lugar de OFFSET, y las filas se leen con un cursor de servidor
+# (SSCursor) a medida que se envían, sin cargar el resultado en memoria.
 
-    return last_date_str, total_pilgrims
\ No newline at end of file
+def stats_tables():
+    return {item['tabla'] + suffix for item in queries_tables for suffix in ('last_day', 'monthly')}
+
+
+def build_stats_query(table, schema, filters=None, start_date=None, end_date=None,
+                      group_by=None, after=None, limit=None):
+    """
+    Returns (sql, values, columns, order_columns) to read `table`.
+
+    `filters` maps dimension columns to lists of accepted values, `group_by`
+    lists the columns to aggregate by (SUM of the pilgrims column), `after`
+    holds the values of `order_columns` of the last row of the previous page.
+    Raises ValueError on unknown columns.
+    """
+    columns = schema['columns']
+    measure = columns[-1]
+    groupable = columns[:-1]
+
+    for column in list(filters or {}) + list(group_by or []):
+        if column not in groupable:
+            raise ValueError(f"Unknown column for {table}: {column}")
+
+    if group_by:
+        order_columns = list(group_by)
+        select = ', '.join(order_columns) + f", SUM({measure}) AS {measure}"
+        result_columns = order_columns + [measure]
+    else:
+        # la clave primaria identifica cada fila; sin ella, todas menos la medida
+        order_columns = [column for column in columns if column in schema['key_columns']] or groupable
+        select = ', '.join(columns)
+        result_columns = list(columns)
+
+    conditions = []
+    values = []
+    if start_date:
+        conditions.append("date >= %s")
+        values.append(start_date)
+    if end_date:
+        conditions.append("date <= %s")
+        values.append(end_date)
+    for column, accepted in (filters or {}).items():
+        conditions.append(f"{column} IN ({', '.join(['%s'] * len(accepted))})")
+        values.extend(accepted)
+    if after is not None:
+        if len(after) != len(order_columns):
+            raise ValueError("Invalid page cursor")
+        conditions.append(f"({', '.join(order_columns)}) > ({', '.join(['%s'] * len(after))})")
+        values.extend(after)
+
+    sql = f"SELECT {select} FROM {table}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    if group_by:
+        sql += f" GROUP BY {', '.join(order_columns)}"
+    sql += f" ORDER BY {', '.join(order_columns)}"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return sql, values, result_columns, order_columns
+
+
+def get_stats_schema(table):
+    # Esquema de una tabla stats_*, desde la caché o con DESCRIBE
+    if table not in stats_tables():
+        raise ValueError(f"Unknown table: {table}")
+    schema = table_schemas.get(table)
+    if schema is None:
+        with db_connection() as connection:
+            if connection is None:
+                raise RuntimeError("Failed to establish a connection.")
+            cursor = connection.cursor()
+            try:
+                schema = get_table_schema(cursor, table)
+            finally:
+                cursor.close()
+    return schema
+
+
+class StreamLimitReached(RuntimeError):
+    """Every streaming slot of this process is busy."""
+
+
+# Las descargas en streaming retienen su conexión mientras el cliente lee, así
+# que no usan el pool compartido (las cargas y / esperarían por él): cada una
+# abre su propia conexión, hasta STATS_MAX_STREAMS a la vez por proceso
+stream_slots = threading.BoundedSemaphore(STATS_MAX_STREAMS)
+
+
+def stream_query(sql, values):
+    """Yields the rows of `sql` one by one from a server-side cursor.
+
+    Runs on a dedicated connection, closed when the generator ends. Raises
+    StreamLimitReached if no streaming slot frees up in STATS_STREAM_WAIT
+    seconds.
+    """
+    if not stream_slots.acquire(timeout=STATS_STREAM_WAIT):
+        raise StreamLimitReached("Too many streaming reads in progress, try again later")
+    try:
+        connection = connect_to_db()
+        if connection is None:
+            raise RuntimeError("Failed to establish a connection.")
+        try:
+            cursor = connection.cursor(pymysql.cursors.SSCursor)
+            cursor.execute(sql, values)
+            for row in cursor:
+                yield row
+        finally:
+            # también si el cliente corta la descarga: cerrar la conexión evita
+            # leer el resto del resultado
+            connection.close()
+    finally:
+        stream_slots.release()
@@ -0,0 +1,104 @@
+import logging
+import os
+import threading
+import time
+
+import pymysql
+
+# Bounded pool of pymysql connections shared by the threads of a process.
+# Idle connections are pinged before reuse when they have been idle for a
+# while and recycled once they reach their maximum lifetime. After a fork
+# the child drops everything inherited from the parent instead of sharing
+# its sockets.
+
+
+class ConnectionPool:
+
+    def __init__(self, connect, max_size=5, max_lifetime=1800,
+                 health_check_interval=30, timeout=30):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._idle = []
+        self._created = {}
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # The parent's sockets are not ours to close
+            self._reset()
+
+    def _discard(self, connection):
+        self._created.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _take_idle(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection, last_used = self._idle.pop()
+
+            if now - self._created.get(id(connection), now) > self.max_lifetime:
+                self._discard(connection)
+                continue
+            if now - last_used > self.health_check_interval:
+                try:
+                    connection.ping(reconnect=False)
+                except pymysql.MySQLError:
+                    self._discard(connection)
+                    continue
+            return connection
+
+    def acquire(self):
+        """Returns a connection from the pool, or None if none is available."""
+        self._check_fork()
+        if not self._slots.acquire(timeout=self.timeout):
+            logging.error("Timed out waiting for a database connection from the pool")
+            return None
+
+        connection = self._take_idle()
+        if connection is None:
+            connection = self.connect()
+            if connection is None:
+                self._slots.release()
+                return None
+            self._created[id(connection)] = time.monotonic()
+        return connection
+
+    def release(self, connection, discard=False):
+        if self._pid != os.getpid() or id(connection) not in self._created:
+            # Checked out before a fork, it belongs to another process
+            return
+        if not discard and connection.open:
+            try:
+                # Ends the implicit transaction so the next user sees fresh data
+                connection.rollback()
+            except pymysql.MySQLError:
+                discard = True
+        else:
+            discard = True
+
+        if discard:
+            self._discard(connection)
+        else:
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+        self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
@@ -0,0 +1,143 @@
+import hashlib
+import time
+import zlib
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from config import *
+from database_functions import stats_tables
+import read_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# HTTP caching for the read routes. The ETag of a response is derived from
+# the URL and the data version of the tables it reads (the version files of
+# read_cache, bumped by every load), so a poll that finds nothing new gets a
+# 304 without running the view or touching MySQL. Requests for unknown tables,
+# or for tables no load has written yet, skip the ETag and go straight to the
+# view. Cache-Control lasts until the next refresh is expected, and bodies
+# are compressed with brotli or gzip when the client accepts it.
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+
+def cacheable_tables():
+    return stats_tables() | {tabla_pilgrims_last_day}
+
+
+def make_etag(tables):
+    # (etag, última escritura), o (None, None) si alguna tabla no es conocida
+    # o aún no tiene versión: la tabla sale de la URL y no se crea nada por ella
+    known = cacheable_tables()
+    digest = hashlib.sha256(request.full_path.encode())
+    written = []
+    for table in tables:
+        if table not in known:
+            return None, None
+        version, written_at = read_cache.data_version(table)
+        if version is None:
+            return None, None
+        digest.update(f"|{table}={version}".encode())
+        written.append(written_at)
+    return digest.hexdigest()[:32], max(written) if written else None
+
+
+def max_age(last_write):
+    # hasta la próxima carga prevista, sin pasar de HTTP_CACHE_MAX_AGE
+    if last_write is None:
+        return 0
+    remaining = last_write + REFRESH_INTERVAL - time.time()
+    return int(min(max(remaining, 0), HTTP_CACHE_MAX_AGE))
+
+
+def _is_error(response):
+    if response.is_streamed or not response.is_json:
+        return False
+    body = response.get_json(silent=True)
+    return isinstance(body, dict) and body.get('status') == 'error'
+
+
+def conditional(tables_of):
+    """Adds ETag/304 handling to a view.
+
+    `tables_of` receives the view arguments and returns the tables whose
+    data the response depends on.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            etag, last_write = make_etag(tables_of(*args, **kwargs))
+            if etag is None:
+                return view(*args, **kwargs)
+            # ETag débil: el cuerpo puede variar (hora actual, compresión)
+            # pero los datos son los mismos
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                # los errores se devuelven con 200 y {"status": "error"}: no se cachean
+                if response.status_code != 200 or _is_error(response):
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = f"private, max-age={max_age(last_write)}"
+            return response
+        return wrapped
+    return decorator
+
+
+def _encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compressor(encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+
+def _compress_stream(chunks, encoding):
+    process, finish = _compressor(encoding)
+    for chunk in chunks:
+        data = process(chunk.encode() if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compress_response(response):
+    # after_request: comprime las respuestas de texto/JSON que lo merecen
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or not response.mimetype.startswith(COMPRESSIBLE_TYPES)):
+        return response
+    encoding = _encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < HTTP_COMPRESS_MIN_BYTES:
+            return response
+        process, finish = _compressor(encoding)
+        response.set_data(process(body) + finish())
+
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from config import *
+
+# Background runner for the update endpoints. The request only records the
+# job and hands it to a worker thread of the same process; status, per-table
+# timings and the result are kept in a SQLite file shared by every gunicorn
+# worker, so /jobs/<id> answers from any of them. Backfills can run for hours,
+# so they get a thread of their own instead of queueing the regular refreshes
+# behind them.
+
+# kind -> executor name; the rest share 'refresh'
+DEDICATED_EXECUTORS = {'backfill': 'backfill'}
+
+_executors = {}
+_executors_pid = None
+_lock = threading.Lock()
+
+
+def connect_jobs_db():
+    connection = sqlite3.connect(JOBS_DB, timeout=30)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            pid INTEGER,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL,
+            result TEXT,
+            report TEXT,
+            error TEXT
+        )""")
+    return connection
+
+
+def _execute(sql, values=()):
+    connection = connect_jobs_db()
+    try:
+        with connection:
+            connection.execute(sql, values)
+    finally:
+        connection.close()
+
+
+def _get_executor(kind):
+    global _executors_pid
+    name = DEDICATED_EXECUTORS.get(kind, 'refresh')
+    with _lock:
+        # los hilos del proceso maestro no existen en los workers
+        if _executors_pid != os.getpid():
+            _executors.clear()
+            _executors_pid = os.getpid()
+        if name not in _executors:
+            workers = JOB_WORKERS if name == 'refresh' else 1
+            _executors[name] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"job-{name}")
+        return _executors[name]
+
+
+def _run(job_id, work):
+    _execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (time.time(), job_id))
+    report = {}
+    try:
+        result = work(report)
+        _execute("""UPDATE jobs SET status = 'done', finished_at = ?, result = ?, report = ?
+                    WHERE id = ?""",
+                 (time.time(), json.dumps(result, default=str), json.dumps(report, default=str), job_id))
+    except Exception as e:
+        logging.error(f"Job {job_id} failed: {e}")
+        _execute("""UPDATE jobs SET status = 'failed', finished_at = ?, report = ?, error = ?
+                    WHERE id = ?""",
+                 (time.time(), json.dumps(report, default=str), str(e), job_id))
+
+
+def submit(kind, work):
+    """Queues work(report) in the background and returns the job id.
+
+    `work` receives an empty report dict to fill in and returns the result,
+    both stored as JSON when it finishes.
+    """
+    job_id = uuid.uuid4().hex
+    _execute("INSERT INTO jobs (id, kind, pid, created_at) VALUES (?, ?, ?, ?)",
+             (job_id, kind, os.getpid(), time.time()))
+    _get_executor(kind).submit(_run, job_id, work)
+    logging.info(f"Job {job_id} ({kind}) queued")
+    return job_id
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def get_job(job_id):
+    connection = connect_jobs_db()
+    try:
+        connection.row_factory = sqlite3.Row
+        row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+
+    job = dict(row)
+    if job['status'] in ('queued', 'running') and not _process_alive(job['pid']):
+        # el worker que la ejecutaba terminó (reinicio, timeout) sin acabarla
+        job['status'] = 'failed'
+        job['error'] = 'The worker running this job exited'
+        _execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                 (job['status'], job['error'], time.time(), job_id))
+
+    for field in ('result', 'report'):
+        if job[field] is not None:
+            job[field] = json.loads(job[field])
+    return job
@@ -1,21 +1,43 @@
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, jsonify, request, abort, stream_with_context
 from functools import wraps
 import pytz
-from datetime import datetime
+from datetime import datetime, date
 import logging
 import hashlib
+import base64
+import itertools
+import json
+from decimal import Decimal
 
 from data_fetcher import *
+from backfill import run_backfill, backfill_progress
 from database_functions import *
+import read_cache
+import jobs
+import query_templates
+import metrics
+import http_cache
 from config import *
 
 app = Flask(__name__)
+metrics.init_app(app)
+http_cache.init_app(app)
 
 logging.basicConfig(level=logging.INFO)
 
-# recupera las templates para todas las funciones
-query_last_day_template, query_year_month_template, query_any_date_template = get_queries_from_db()
-logging.info("Templates retrieved...")
+# las templates se cargan y se comprueban periódicamente en segundo plano y
+# se piden en cada endpoint, sin bloquear el arranque del worker
+query_templates.start_checker()
+
+# tabla de resumen de / y /daily_totals; si falla las cargas siguen y las
+# lecturas suman las tablas
+for problem in create_daily_totals_table():
+    logging.warning(f"Daily totals: {problem}")
+
+# opcionalmente valida y precarga el esquema de las tablas destino
+if CHECK_SCHEMAS_ON_STARTUP:
+    for problem in check_table_schemas():
+        logging.warning(f"Schema check: {problem}")
 
 def require_auth(f):
     @wraps(f)
@@ -42,55 +64,103 @@ def require_auth(f):
 
 @app.route('/')
 @require_auth
+@http_cache.conditional(lambda: [tabla_check])
 def home():
 
     madrid_tz = pytz.timezone('Europe/Madrid')
     current_time = datetime.now(madrid_tz).strftime('%Y-%m-%d %H:%M:%S %Z%z')
-    # connect to mySQL to get the last day and total number of pilgrims
-    last_day, total_pilgrims = get_sum_pilgrims_last_day()
+    # connect to mySQL to get the last day and total number of pilgrims,
+    # unless a recent result is still cached
+    last_day, total_pilgrims = read_cache.get(tabla_check, get_sum_pilgrims_last_day)
     last_day_formatted = last_day.strftime('%Y-%m-%d')
     logging.info("Connection completed")
     return jsonify({"status": "success", "message": "Statistics API is running", "last_day": last_day_formatted, "total_pilgrims": total_pilgrims, "current_time": current_time})
 
 
+def run_update(kind, work, message):
+    # Por defecto la actualización se encola en segundo plano y se devuelve el
+    # id del trabajo; con ?sync=1 se ejecuta dentro de la petición
+    if request.args.get('sync', 'false').lower() in ('1', 'true'):
+        report = {}
+        try:
+            result = work(report)
+        except Exception as e:
+            logging.error(f"An error occurred: {str(e)}")
+            return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"})
+        return jsonify({"status": "success", "message": message, **result, "skipped_tables": report.get('skipped', 0)})
+
+    job_id = jobs.submit(kind, work)
+    return jsonify({"status": "success", "message": "Update queued", "job_id": job_id, "job_url": f"/jobs/{job_id}"}), 202
+
+
 @app.route('/update_stats_last_day')
 @require_auth
 def update_last_day():
 
+    query_last_day_template, query_year_month_template, query_any_date_template = query_templates.get_templates()
     if not query_last_day_template or not query_year_month_template:
         logging.warning("Template(s) are empty, aborting update")
         return jsonify({"status": "error", "message": "Template(s) are empty, unable to update statistics"})
 
-    try:
+    def work(report):
         logging.info("Starting LAST DAY update")
         pilgrims = update_stats_last_day(
             query_last_day_template,
-            query_year_month_template)
-        logging.info("Finishing LAST_DAY update")
-        return jsonify({"status": "success", "message": "Last day's statistics updated", "pilgrims": pilgrims})
-    except Exception as e:
-        logging.error(f"An error occurred: {str(e)}")
-        return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"})
+            query_year_month_template,
+            report=report)
+        logging.info(f"Finishing LAST_DAY update ({report.get('skipped', 0)} unchanged tables skipped)")
+        return {"pilgrims": pilgrims}
+
+    return run_update('last_day', work, "Last day's statistics updated")
 
 
 @app.route('/update_stats_current_month')
 @require_auth
 def update_year_month():
 
+    query_last_day_template, query_year_month_template, query_any_date_template = query_templates.get_templates()
     if not query_year_month_template:
         logging.warning("Template(s) are empty, aborting update")
         return jsonify({"status": "error", "message": "Template(s) are empty, unable to update statistics"})
 
-
-    try:
+    def work(report):
         logging.info("Starting current MONTH update")
         pilgrims = update_stats_year_month(
-            query_year_month=query_year_month_template, incremental=True)
-        logging.info("Finishing YEAR_MONTH update")
-        return jsonify({"status": "success", "message": "Statistics for the current month updated", "pilgrims": pilgrims})
-    except Exception as e:
-        logging.error(f"An error occurred: {str(e)}")
-        return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"})
+            query_year_month=query_year_month_template, incremental=True, report=report)
+        logging.info(f"Finishing YEAR_MONTH update ({report.get('skipped', 0)} unchanged tables skipped)")
+        return {"pilgrims": pilgrims}
+
+    return run_update('current_month', work, "Statistics for the current month updated")
+
+
+@app.route('/update_stats_backfill')
+@require_auth
+def update_backfill():
+
+    query_last_day_template, query_year_month_template, query_any_date_template = query_templates.get_templates()
+    if not query_year_month_template:
+        logging.warning("Template(s) are empty, aborting update")
+        return jsonify({"status": "error", "message": "Template(s) are empty, unable to update statistics"})
+
+    try:
+        start_year = int(request.args.get('start_year', 2003))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid start_year"})
+    restart = request.args.get('restart', 'false').lower() == 'true'
+
+    def work(report):
+        logging.info("Starting BACKFILL")
+        summary = run_backfill(query_year_month_template, start_year, restart=restart)
+        logging.info("Finishing BACKFILL")
+        return summary
+
+    return run_update('backfill', work, "Historical statistics backfilled")
+
+
+@app.route('/backfill_status')
+@require_auth
+def backfill_status():
+    return jsonify({"status": "success", "units": backfill_progress()})
 
 
 @app.route('/update_stats_by_day/', defaults={'dates': None})
@@ -99,29 +169,39 @@ def update_year_month():
 def update_date(dates):
     if not dates:
         return jsonify({"status": "success", "message": "No dates provided, no action taken"})
-    
+
+    query_last_day_template, query_year_month_template, query_any_date_template = query_templates.get_templates()
     if not query_last_day_template or not query_year_month_template:
         logging.warning("Template(s) are empty, aborting update")
         return jsonify({"status": "error", "message": "Template(s) are empty, unable to update statistics"})
 
-    try:
-        # Split the dates string into a list of date strings
-        date_list = dates.split(',')
-
-        formatted_dates = []
-        # Optionally, validate the date format
-        for date_str in date_list:
-            try:
-                date_obj = datetime.strptime(date_str, '%d-%m-%Y')
-                formatted_date_str = date_obj.strftime('%d/%m/%Y')
-                formatted_dates.append(formatted_date_str)
-            except ValueError:
-                return jsonify({"status": "error", "message": f"Invalid date format: {date_str}"})
-
-        pilgrims = update_stats_date(query_any_date_template, formatted_dates)
-        return jsonify({"status": "success", "message": "Statistics for the list of dates updated", "pilgrims": pilgrims})
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"})
+    # Split the dates string into a list of date strings
+    date_list = dates.split(',')
+
+    formatted_dates = []
+    # Optionally, validate the date format
+    for date_str in date_list:
+        try:
+            date_obj = datetime.strptime(date_str, '%d-%m-%Y')
+            formatted_date_str = date_obj.strftime('%d/%m/%Y')
+            formatted_dates.append(formatted_date_str)
+        except ValueError:
+            return jsonify({"status": "error", "message": f"Invalid date format: {date_str}"})
+
+    def work(report):
+        pilgrims = update_stats_date(query_any_date_template, formatted_dates, report=report)
+        return {"pilgrims": pilgrims}
+
+    return run_update('by_day', work, "Statistics for the list of dates updated")
+
+
+@app.route('/jobs/<job_id>')
+@require_auth
+def job_status(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": f"Unknown job: {job_id}"}), 404
+    return jsonify({"status": "success", "job": job})
 
 
 @app.route('/update_now')
@@ -141,9 +221,10 @@ def update_now():
 
 @app.route('/now')
 @require_auth
+@http_cache.conditional(lambda: [tabla_pilgrims_last_day])
 def pilgrims_now():
     try:
-        last_day, total_pilgrims = get_pilgrims_last_day()
+        last_day, total_pilgrims = read_cache.get(tabla_pilgrims_last_day, get_pilgrims_last_day)
         logging.info("Connection completed")
         return jsonify({"status": "success", "message": "Number of pilgrims recorded", "date": last_day, "pilgrims": total_pilgrims})
     except Exception as e:
@@ -151,5 +232,121 @@ def pilgrims_now():
         return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"})
 
 
+@app.route('/daily_totals')
+@require_auth
+@http_cache.conditional(lambda: [request.args.get('table', tabla_check)])
+def daily_totals():
+    table = request.args.get('table', tabla_check)
+    if table not in stats_tables():
+        return jsonify({"status": "error", "message": f"Unknown table: {table}"}), 400
+    try:
+        totals = get_daily_totals(table, request.args.get('from'), request.args.get('to'))
+        if totals is None:
+            return jsonify({"status": "error", "message": "Unable to read the daily totals"})
+        return jsonify({"status": "success", "message": "Daily totals", "table": table, "totals": totals})
+    except Exception as e:
+        logging.error(f"An error occurred: {str(e)}")
+        return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"})
+
+
+def json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def encode_page_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_page_cursor(token):
+    try:
+        after = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except ValueError:
+        raise ValueError("Invalid page cursor")
+    # JSON válido pero que no es una lista de valores (p. ej. 'MQ==' es 1)
+    if not isinstance(after, list) or not all(
+            value is None or isinstance(value, (str, int, float)) for value in after):
+        raise ValueError("Invalid page cursor")
+    return after
+
+
+STATS_RESERVED_ARGS = {'from', 'to', 'group_by', 'after', 'limit', 'format'}
+
+
+# Filas de una tabla stats_* en NDJSON (por defecto) o JSON, en streaming.
+# Filtros: ?from=&to= (fechas) y ?<columna>=<valor> (repetible); ?group_by=
+# agrega por esas columnas en SQL. La última línea NDJSON ({"_next", "_count"})
+# o la clave "next" del JSON llevan el cursor de la página siguiente (?after=)
+@app.route('/stats/<name>/<period>')
+@require_auth
+@http_cache.conditional(lambda name, period: [f"stats_{name}_{period}"])
+def stats_rows(name, period):
+    args = request.args
+    try:
+        limit = int(args.get('limit', STATS_PAGE_SIZE))
+        if limit < 0 or limit > STATS_MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 0 and {STATS_MAX_PAGE_SIZE}")
+        table = f"stats_{name}_{period}"
+        schema = get_stats_schema(table)
+        group_by = [column for column in args.get('group_by', '').split(',') if column]
+        filters = {key: args.getlist(key) for key in args if key not in STATS_RESERVED_ARGS}
+        after = decode_page_cursor(args['after']) if args.get('after') else None
+        sql, values, columns, order_columns = build_stats_query(
+            table, schema, filters, args.get('from'), args.get('to'), group_by, after, limit)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        logging.error(f"An error occurred: {str(e)}")
+        return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"}), 500
+
+    # la primera fila se lee antes de responder para poder devolver un error
+    # normal si falla la conexión o la consulta
+    rows = stream_query(sql, values)
+    try:
+        first = next(rows, None)
+    except StreamLimitReached as e:
+        return jsonify({"status": "error", "message": str(e)}), 503, {"Retry-After": str(int(STATS_STREAM_WAIT) or 1)}
+    except Exception as e:
+        logging.error(f"An error occurred: {str(e)}")
+        return jsonify({"status": "error", "message": f"An error occurred: {str(e)}"}), 500
+
+    ndjson = args.get('format', 'ndjson') != 'json'
+
+    def generate():
+        count = 0
+        last = None
+        if not ndjson:
+            yield '{"status": "success", "rows": ['
+        if first is not None:
+            for row in itertools.chain([first], rows):
+                record = dict(zip(columns, map(json_value, row)))
+                if ndjson:
+                    yield json.dumps(record) + '\n'
+                else:
+                    yield (',' if count else '') + json.dumps(record)
+                count += 1
+                last = record
+        next_cursor = None
+        if limit and count == limit:
+            next_cursor = encode_page_cursor([last[column] for column in order_columns])
+        if ndjson:
+            yield json.dumps({"_next": next_cursor, "_count": count}) + '\n'
+        else:
+            yield f'], "next": {json.dumps(next_cursor)}, "count": {count}}}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+@app.route('/metrics')
+@require_auth
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
 if __name__ == "__main__":
     app.run()
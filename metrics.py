@@ -0,0 +1,89 @@
+import os
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from prometheus_client import (CollectorRegistry, Counter, Histogram, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+
+from config import *
+
+# Prometheus metrics for the refresh pipeline and the Flask routes. Each
+# stage (fetch, build_dataframe, rollup, store...) is timed per destination
+# table. Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory
+# so /metrics adds up the samples of every worker.
+
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram('stats_stage_seconds', 'Duration of each pipeline stage',
+                          ['stage', 'table'], buckets=STAGE_BUCKETS)
+STAGE_ERRORS = Counter('stats_stage_errors', 'Pipeline stages that failed', ['stage', 'table'])
+STAGE_ROWS = Counter('stats_stage_rows', 'Rows handled by a pipeline stage', ['stage', 'table'])
+PAYLOAD_BYTES = Counter('stats_pbi_payload_bytes', 'Bytes of the Power BI responses',
+                        ['table', 'encoding'])
+SKIPPED_TABLES = Counter('stats_skipped_tables', 'Loads skipped because the response did not change',
+                         ['table'])
+RATE_LIMIT_WAIT = Histogram('stats_pbi_rate_limit_wait_seconds', 'Time spent waiting for the PBI budget',
+                            buckets=(0, 0.1, 1, 5, 10, 30, 60, 300))
+REQUEST_SECONDS = Histogram('stats_http_request_seconds', 'Latency of the Flask routes',
+                            ['route', 'method', 'status'])
+
+
+@contextmanager
+def stage(name, table=''):
+    # Mide la duración de la etapa y cuenta un error si lanza una excepción
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(name, table).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(name, table).observe(time.perf_counter() - start)
+
+
+def record_error(name, table=''):
+    STAGE_ERRORS.labels(name, table).inc()
+
+
+def record_rows(name, table, rows):
+    STAGE_ROWS.labels(name, table).inc(rows)
+
+
+def record_payload(table, bytes_wire, bytes_decoded):
+    PAYLOAD_BYTES.labels(table, 'wire').inc(bytes_wire)
+    PAYLOAD_BYTES.labels(table, 'decoded').inc(bytes_decoded)
+
+
+def record_skipped(table):
+    SKIPPED_TABLES.labels(table).inc()
+
+
+def record_rate_limit_wait(seconds):
+    RATE_LIMIT_WAIT.observe(seconds)
+
+
+def init_app(app):
+    # Latencia de cada ruta, etiquetada con la regla y no con la URL para no
+    # crear una serie por cada lista de fechas
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            REQUEST_SECONDS.labels(route, request.method, str(response.status_code)).observe(
+                time.perf_counter() - start)
+        return response
+
+
+def render():
+    """Returns (body, content type) of the metrics in Prometheus text format."""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
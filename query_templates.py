@@ -0,0 +1,92 @@
+import logging
+import os
+import threading
+import time
+
+from config import *
+from database_functions import db_connection, get_queries_checksum, read_queries
+
+# Process-wide cache of the three query templates stored in db_queries_stats.
+# They are loaded on first use instead of at import time, and a background
+# thread compares a checksum of the table with the one loaded every
+# TEMPLATE_CHECK_INTERVAL seconds (TEMPLATE_RETRY_INTERVAL after a failure),
+# so template edits are picked up without a restart and requests never wait
+# on that check.
+
+EMPTY = (None, None, None)
+
+_templates = EMPTY
+_checksum = None
+_checked_at = None
+_failed_at = None
+_checker_pid = None
+_lock = threading.Lock()
+
+
+def _load():
+    # Lee las plantillas si su checksum ha cambiado; devuelve False si falla
+    global _templates, _checksum, _checked_at, _failed_at
+    try:
+        with db_connection() as connection:
+            if connection is None:
+                raise RuntimeError("Failed to establish a connection.")
+            checksum = get_queries_checksum(connection)
+            templates = read_queries(connection) if checksum != _checksum else None
+    except Exception as e:
+        logging.error(f"Could not load the query templates: {e}")
+        with _lock:
+            _failed_at = time.monotonic()
+        return False
+
+    with _lock:
+        if templates is not None:
+            if _checksum is not None:
+                logging.info("Query templates changed, reloaded")
+            _templates = templates
+            _checksum = checksum
+        _checked_at = time.monotonic()
+        _failed_at = None
+    return True
+
+
+def _check_forever():
+    while True:
+        loaded = _load()
+        time.sleep(TEMPLATE_CHECK_INTERVAL if loaded else TEMPLATE_RETRY_INTERVAL)
+
+
+def start_checker():
+    """Starts the background thread that loads and checks the templates.
+
+    One thread per process: a gunicorn worker forked after the call starts
+    its own on its first get_templates().
+    """
+    global _checker_pid
+    with _lock:
+        if _checker_pid == os.getpid():
+            return
+        _checker_pid = os.getpid()
+    threading.Thread(target=_check_forever, name='query-templates', daemon=True).start()
+
+
+def get_templates():
+    """Returns (query_last_day, query_year_month, query_any_date).
+
+    The first call loads them if the background thread has not done it yet;
+    later calls return the cached templates. Returns (None, None, None) while
+    they cannot be loaded.
+    """
+    start_checker()
+    now = time.monotonic()
+    with _lock:
+        templates, checked_at, failed_at = _templates, _checked_at, _failed_at
+
+    if checked_at is None:
+        # nunca se han cargado: esperar a la carga salvo si acaba de fallar
+        if failed_at is not None and now - failed_at < TEMPLATE_RETRY_INTERVAL:
+            return EMPTY
+        _load()
+        with _lock:
+            return _templates
+
+    return templates
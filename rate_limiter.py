@@ -0,0 +1,61 @@
+import fcntl
+import json
+import os
+import time
+
+from config import *
+
+# Token bucket shared by every thread and gunicorn worker on the host. The
+# state lives in a small JSON file guarded by flock, so the hourly Power BI
+# budget holds across endpoints and overlapping runs.
+
+RATE_PER_SECOND = PBI_HOURLY_BUDGET / 3600
+
+
+def _take_token():
+    # Returns 0 if a token was taken, otherwise the seconds until one is free
+    with open(RATE_LIMIT_FILE, 'a+') as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        try:
+            state_file.seek(0)
+            content = state_file.read()
+            now = time.time()
+            try:
+                state = json.loads(content)
+                tokens = state['tokens']
+                elapsed = max(now - state['updated'], 0)
+            except (ValueError, KeyError, TypeError):
+                tokens = PBI_BURST
+                elapsed = 0
+
+            tokens = min(PBI_BURST, tokens + elapsed * RATE_PER_SECOND)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / RATE_PER_SECOND
+
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps({'tokens': tokens, 'updated': now}))
+            state_file.flush()
+            return wait
+        finally:
+            fcntl.flock(state_file, fcntl.LOCK_UN)
+
+
+def acquire():
+    """Blocks until the shared budget allows one more Power BI request.
+
+    Returns the number of seconds spent waiting.
+    """
+    if TRANSPORT_MODE == 'replay':
+        # las respuestas salen del archivo local, no gastan presupuesto
+        return 0
+    waited = 0
+    while True:
+        wait = _take_token()
+        if wait <= 0:
+            return waited
+        time.sleep(wait)
+        waited += wait
@@ -0,0 +1,102 @@
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+
+from config import *
+
+# Archive of the raw Power BI responses, one gzip file per destination table
+# and period (RAW_ARCHIVE_DIR/<table>/<period>.jsonl.gz). Each line holds one
+# event of stream_dsr -- the descriptor, every DM0 row still compressed with
+# its R/Ø bitsets, the ValueDicts -- so the decoder can be run again over
+# them later without asking Power BI. Responses of several dates (see
+# update_stats_date) are kept as <first>..<last>.jsonl.gz with the list of
+# dates as their first event. Nothing is ever deleted: the archive keeps
+# one file per table and period that has been loaded.
+
+SUFFIX = '.jsonl.gz'
+
+
+def archive_path(table, period):
+    return os.path.join(RAW_ARCHIVE_DIR, table, f"{period}{SUFFIX}")
+
+
+def record_events(events, table, period, dates=None):
+    """Passes the events through while writing them to the archive.
+
+    The file only replaces the previous one for the same table and period if
+    the response was read to the end.
+    """
+    path = archive_path(table, period)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    completed = False
+    try:
+        with gzip.open(tmp_file, 'wt', encoding='utf-8') as archive_file:
+            if dates is not None:
+                archive_file.write(json.dumps(['dates', dates]) + '\n')
+            for kind, value in events:
+                archive_file.write(json.dumps([kind, value], ensure_ascii=False, separators=(',', ':')) + '\n')
+                yield kind, value
+        os.replace(tmp_file, path)
+        completed = True
+    finally:
+        if not completed:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+
+def archive_events(events, table, period, dates=None):
+    # Solo graba si el archivo está activado
+    if not RAW_ARCHIVE_ENABLED:
+        return events
+    return record_events(events, table, period, dates)
+
+
+def read_events(path):
+    # Emite los eventos guardados, en el mismo formato que stream_dsr
+    with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+        for line in archive_file:
+            kind, value = json.loads(line)
+            yield kind, value
+
+
+def read_dates(path):
+    # Lista de fechas de un archivo de varias fechas, o None
+    with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+        kind, value = json.loads(archive_file.readline())
+    return value if kind == 'dates' else None
+
+
+def archived_files(table):
+    """Returns {period: path} of the archived responses of a table.
+
+    Periods covered by several files (a single date and a batch) take the
+    most recently written one.
+    """
+    newest = {}
+    for path in glob.glob(os.path.join(RAW_ARCHIVE_DIR, table, '*' + SUFFIX)):
+        name = os.path.basename(path)[:-len(SUFFIX)]
+        mtime = os.path.getmtime(path)
+        if '..' in name:
+            try:
+                periods = [date_to_period(date) for date in read_dates(path) or []]
+            except (OSError, ValueError) as e:
+                logging.error(f"Unreadable archive {path}: {e}")
+                continue
+        else:
+            periods = [name]
+        for period in periods:
+            if period not in newest or newest[period][1] < mtime:
+                newest[period] = (path, mtime)
+    return {period: path for period, (path, _) in sorted(newest.items())}
+
+
+def date_to_period(date):
+    # dd/mm/YYYY -> YYYY-mm-dd, como las fechas que se guardan en la base de datos
+    day, month, year = date.split('/')
+    return f"{year}-{month}-{day}"
@@ -0,0 +1,111 @@
+import logging
+import os
+import re
+import threading
+import time
+
+from config import *
+
+# In-process cache for the read endpoints, keyed by the table they read. An
+# entry is served until its TTL runs out or until a write path calls
+# invalidate() for that table. Invalidations bump a small version file next
+# to the cache, so every gunicorn worker drops its copy on the next request
+# without asking MySQL.
+
+_entries = {}
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def _version_file(key):
+    # la clave puede venir de la petición: solo letras, dígitos y _
+    return os.path.join(READ_CACHE_DIR, f"read_cache_{re.sub(r'[^A-Za-z0-9_]', '_', key)}.version")
+
+
+def _version(key):
+    try:
+        with open(_version_file(key)) as version_file:
+            return version_file.read()
+    except FileNotFoundError:
+        return ''
+
+
+def data_version(key):
+    """Returns (version, written_at) of the data of `key`.
+
+    The version changes on every invalidate(). Returns (None, None) while
+    no write has created the version file yet; reads never create it.
+    """
+    path = _version_file(key)
+    try:
+        with open(path) as version_file:
+            version = version_file.read()
+        written_at = os.path.getmtime(path)
+    except OSError:
+        return None, None
+    return (version, written_at) if version else (None, None)
+
+
+def _load(key, loader, version):
+    value = loader()
+    # los fallos (None) no se guardan, se reintenta en la siguiente petición
+    if value is not None:
+        with _lock:
+            _entries[key] = {'value': value, 'version': version, 'loaded_at': time.monotonic()}
+    return value
+
+
+def _refresh(key, loader, version):
+    try:
+        _load(key, loader, version)
+    except Exception as e:
+        logging.error(f"Read cache refresh of {key} failed: {e}")
+    finally:
+        with _lock:
+            _refreshing.discard(key)
+
+
+def _refresh_in_background(key, loader, version):
+    with _lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    threading.Thread(target=_refresh, args=(key, loader, version), daemon=True).start()
+
+
+def get(key, loader):
+    """Returns the cached result of loader() for `key`, loading it if needed.
+
+    Expired entries are served for READ_CACHE_STALE more seconds while a
+    background thread reloads them; invalidated entries are always reloaded.
+    """
+    if READ_CACHE_TTL <= 0:
+        return loader()
+
+    version = _version(key)
+    with _lock:
+        entry = _entries.get(key)
+
+    if entry is not None and entry['version'] == version:
+        age = time.monotonic() - entry['loaded_at']
+        if age < READ_CACHE_TTL:
+            return entry['value']
+        if age < READ_CACHE_TTL + READ_CACHE_STALE:
+            _refresh_in_background(key, loader, version)
+            return entry['value']
+
+    return _load(key, loader, version)
+
+
+def invalidate(key):
+    # Una versión nueva en el fichero invalida la entrada en todos los procesos
+    path = _version_file(key)
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_file, 'w') as version_file:
+            version_file.write(f"{time.time_ns()}-{os.urandom(4).hex()}")
+        os.replace(tmp_file, path)
+    except OSError as e:
+        logging.error(f"Could not invalidate the read cache of {key}: {e}")
+    with _lock:
+        _entries.pop(key, None)
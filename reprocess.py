@@ -0,0 +1,157 @@
+"""Rebuilds stats tables from the raw response archive, without calling Power BI.
+
+    python reprocess.py
+    python reprocess.py --tables stats_camino_ stats_means_ --suffix monthly --from 2020-01-01
+    python reprocess.py --dry-run
+
+Each archived response is decoded again with the current decoder, the tables
+derived from it are rolled up (or read from their own archived response when
+the source filled the query window), and the result replaces the rows of that
+period (insert_data_into_db with incremental=True). The work is spread over
+a process pool, one archived file per task. A JSON summary is printed.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import *
+from data_transformer import (decode_stream, dimension_columns, query_window, rollup_dataframe,
+                              split_by_date)
+from database_functions import insert_data_into_db
+import query_templates
+import raw_archive
+
+SUFFIXES = ('last_day', 'monthly')
+
+items = {item['tabla']: item for item in queries_tables}
+
+
+def plan(tablas, suffixes, start=None, end=None):
+    # Unidades de trabajo: (tabla origen, sufijo, ruta, periodos, tablas destino).
+    # Las tablas derivadas se reconstruyen a partir del archivo de su origen
+    targets_by_source = {}
+    for tabla in tablas:
+        targets_by_source.setdefault(items[tabla].get('derived_from', tabla), []).append(tabla)
+
+    units = []
+    for suffix in suffixes:
+        for source, targets in targets_by_source.items():
+            periods_by_path = {}
+            for period, path in raw_archive.archived_files(source + suffix).items():
+                if (start and period < start) or (end and period > end):
+                    continue
+                periods_by_path.setdefault(path, []).append(period)
+            for path, periods in periods_by_path.items():
+                units.append((source, suffix, path, periods, targets))
+    return units
+
+
+def period_frames(path, periods, dimensions):
+    # {periodo: DataFrame} de un archivo; uno de varias fechas se separa por
+    # día, como en fetch_dates
+    df = decode_stream(raw_archive.read_events(path), dimensions)
+    dates = raw_archive.read_dates(path)
+    if dates is None:
+        return {periods[0]: df}
+    by_period = {raw_archive.date_to_period(date): date for date in dates}
+    split = split_by_date(df, [by_period[period] for period in periods], dimensions)
+    return {period: split[by_period[period]] for period in periods}
+
+
+def direct_frame(target, suffix, period):
+    # Respuesta propia de una tabla derivada, que se pidió aparte porque la
+    # de su origen llenaba la ventana de filas de la consulta
+    path = raw_archive.archived_files(target + suffix).get(period)
+    if path is None:
+        raise RuntimeError(f"the source of {target}{suffix} ({period}) reaches the query window "
+                           f"and there is no archived response of its own")
+    return period_frames(path, [period], items[target]['dimensions'])[period]
+
+
+def process(unit, columns_by_dimension, window=None, dry_run=False):
+    source, suffix, path, periods, targets = unit
+    frames = period_frames(path, periods, items[source]['dimensions'])
+
+    results = []
+    for period, period_df in frames.items():
+        truncated = window is not None and len(period_df) >= window
+        for target in targets:
+            target_dimensions = items[target]['dimensions']
+            if target == source:
+                target_df = period_df
+            elif truncated:
+                # agregar un cubo cortado daría totales por debajo de los reales
+                target_df = direct_frame(target, suffix, period)
+            else:
+                target_df = rollup_dataframe(
+                    period_df, [columns_by_dimension[dim] for dim in target_dimensions], target_dimensions)
+            if not dry_run and insert_data_into_db(target_df, target + suffix, period, incremental=True) is None:
+                raise RuntimeError(f"insert into {target}{suffix} ({period}) failed")
+            results.append({'table': target + suffix, 'period': period,
+                            'rows': len(target_df), 'pilgrims': int(target_df['M0'].sum())})
+    return results
+
+
+def reprocess(tablas=None, suffixes=SUFFIXES, start=None, end=None, workers=None, dry_run=False):
+    tablas = tablas or list(items)
+    unknown = [tabla for tabla in tablas if tabla not in items]
+    if unknown:
+        raise ValueError(f"Unknown tables: {', '.join(unknown)}")
+
+    columns_by_dimension = {}
+    window = None
+    if any('derived_from' in items[tabla] for tabla in tablas):
+        # los nombres de columna de cada dimensión y la ventana de filas salen
+        # de la plantilla
+        query_year_month = query_templates.get_templates()[1]
+        if not query_year_month:
+            raise RuntimeError("The query templates are needed to roll up derived tables")
+        columns_by_dimension = dimension_columns(query_year_month)
+        window = query_window(query_year_month)
+
+    units = plan(tablas, suffixes, start, end)
+    started = time.monotonic()
+    logging.info(f"Reprocessing {len(units)} archived responses")
+
+    done = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(process, unit, columns_by_dimension, window, dry_run): unit for unit in units}
+        for future in as_completed(futures):
+            source, suffix, path, periods, targets = futures[future]
+            try:
+                done.extend(future.result())
+            except Exception as e:
+                logging.error(f"Reprocessing {path} failed: {e}")
+                failed.append({'file': path, 'tables': [target + suffix for target in targets],
+                               'periods': periods, 'error': str(e)})
+
+    done.sort(key=lambda result: (result['table'], result['period']))
+    return {'files': len(units), 'tables': done, 'failed': failed,
+            'seconds': time.monotonic() - started, 'dry_run': dry_run}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tables', nargs='*', help=f"queries_tables entries ({', '.join(items)})")
+    parser.add_argument('--suffix', choices=SUFFIXES + ('all',), default='all')
+    parser.add_argument('--from', dest='start', help="first period, YYYY-MM-DD")
+    parser.add_argument('--to', dest='end', help="last period, YYYY-MM-DD")
+    parser.add_argument('--workers', type=int, help="processes (default: one per core)")
+    parser.add_argument('--dry-run', action='store_true', help="decode only, do not write to the database")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    suffixes = SUFFIXES if args.suffix == 'all' else (args.suffix,)
+    summary = reprocess(args.tables, suffixes, args.start, args.end, args.workers, args.dry_run)
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import fcntl
+import json
+import os
+
+from config import *
+
+# On-disk record of the content hash of the last result loaded for each
+# (table, period), plus its pilgrim total. A refresh whose hash matches can
+# skip building the DataFrame and writing it to the database.
+
+
+def _key(table, period):
+    return f"{table}|{period}"
+
+
+def _read():
+    try:
+        with open(RESPONSE_CACHE_FILE) as cache_file:
+            return json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def get_entry(table, period):
+    return _read().get(_key(table, period))
+
+
+def _update(change):
+    # Read-modify-write under an exclusive lock, then an atomic replace so
+    # readers never see a half-written file
+    with open(RESPONSE_CACHE_FILE + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            entries = change(_read())
+            tmp_file = f"{RESPONSE_CACHE_FILE}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp_file, RESPONSE_CACHE_FILE)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def set_entry(table, period, content_hash, total):
+    def change(entries):
+        entries[_key(table, period)] = {'hash': content_hash, 'total': total}
+        return entries
+    _update(change)
+
+
+def invalidate(table=None, period=None):
+    # Forget one entry, every period of a table, or everything
+    def change(entries):
+        if table is None:
+            return {}
+        if period is None:
+            return {key: value for key, value in entries.items()
+                    if not key.startswith(table + '|')}
+        entries.pop(_key(table, period), None)
+        return entries
+    _update(change)
@@ -0,0 +1,103 @@
+import copy
+import io
+import json
+
+import pandas as pd
+import pytest
+
+from benchmarks.fixtures import dsr_payload
+from data_transformer import (extract, convert_to_dataframe, decode_to_dataframe, decode_stream,
+                              dsr_events, stream_dsr)
+
+# The columnar decoders must give exactly the DataFrame of the original
+# extract + convert_to_dataframe path.
+
+
+def legacy_dataframe(payload, dims):
+    columns, dm0 = extract(copy.deepcopy(payload))
+    return convert_to_dataframe(columns, dm0, dims)
+
+
+def decoded_dataframes(payload, dims):
+    raw = json.dumps(payload).encode()
+    return {
+        'decode_to_dataframe': decode_to_dataframe(copy.deepcopy(payload), dims),
+        'decode_stream': decode_stream(stream_dsr(io.BytesIO(raw)), dims),
+        'dsr_events': decode_stream(dsr_events(copy.deepcopy(payload)), dims),
+    }
+
+
+def empty_payload(dims):
+    payload = dsr_payload(dims, 4, seed=1)
+    payload['results'][0]['result']['data']['dsr']['DS'][0]['PH'][0]['DM0'] = []
+    return payload
+
+
+def hand_written_payload():
+    # R/Ø bitsets, an index outside the ValueDict path (a raw string), a null
+    # first column (N/A), newlines and the 'L' suffix of the measure
+    dm0 = [
+        {"S": [{"N": "G0", "T": 1, "DN": "D0"}, {"N": "G1", "T": 1, "DN": "D1"}, {"N": "M0", "T": 4}],
+         "C": [0, 0, "12L"]},
+        {"R": 1, "C": [1, "7L"]},
+        {"R": 1, "Ø": 2, "C": ["3L"]},
+        {"Ø": 1, "C": ["raw\nvalue", "40L"]},
+        {"C": [1, 1, "5L"]},
+    ]
+    select = [{"Kind": 1, "Value": "G0", "GroupKeys": [{"Source": {"Property": "Camino"}}]},
+              {"Kind": 1, "Value": "G1", "GroupKeys": [{"Source": {"Property": "Pais"}}]},
+              {"Kind": 2, "Value": "M0"}]
+    value_dicts = {"D0": ["Francés", "Norte\n"], "D1": ["España", "Italia"]}
+    return {"results": [{"result": {"data": {
+        "descriptor": {"Select": select},
+        "dsr": {"DS": [{"PH": [{"DM0": dm0}], "ValueDicts": value_dicts}]}}}}]}
+
+
+CASES = [
+    ('one_dimension', ['d2'], dsr_payload(['d2'], 4, seed=1)),
+    ('cube', ['d1', 'd5', 'd4'], dsr_payload(['d1', 'd5', 'd4'], 800, seed=2, null_ratio=0.1)),
+    ('two_dimensions', ['d1', 'd5'], dsr_payload(['d1', 'd5'], 300, seed=7, null_ratio=0.1)),
+    ('hand_written', ['d1', 'd5'], hand_written_payload()),
+    ('empty_dm0', ['d2'], empty_payload(['d2'])),
+]
+
+
+@pytest.mark.parametrize('name, dims, payload', CASES, ids=[case[0] for case in CASES])
+def test_matches_legacy_decoder(name, dims, payload):
+    expected = legacy_dataframe(payload, dims)
+    for decoder, df in decoded_dataframes(payload, dims).items():
+        pd.testing.assert_frame_equal(df, expected, obj=decoder)
+
+
+def test_hand_written_values():
+    df = decode_to_dataframe(hand_written_payload(), ['d1', 'd5'])
+    assert df.to_dict('records') == [
+        {'Camino': 'Francés', 'Pais': 'España', 'M0': 12},
+        {'Camino': 'Francés', 'Pais': 'Italia', 'M0': 7},
+        {'Camino': 'Francés', 'Pais': 'N/A', 'M0': 3},
+        {'Camino': 'N/A', 'Pais': 'rawvalue', 'M0': 40},
+        {'Camino': 'Norte', 'Pais': 'Italia', 'M0': 5},
+    ]
+
+
+def test_decoder_leaves_response_untouched():
+    payload = hand_written_payload()
+    original = copy.deepcopy(payload)
+    decode_to_dataframe(payload, ['d1', 'd5'])
+    assert payload == original
+
+
+ERROR_BODIES = [
+    ('error_object', {"error": {"code": "QueryUserError", "pbi.error": {"code": "QueryExecutionError"}}}),
+    ('no_dm0', {"results": [{"result": {"data": {"dsr": {"DS": [{"N": "DS0"}]}}}}]}),
+]
+
+
+@pytest.mark.parametrize('name, payload', ERROR_BODIES, ids=[case[0] for case in ERROR_BODIES])
+def test_error_bodies_raise(name, payload):
+    # the legacy path fails on these bodies; the streamed decoder must too,
+    # instead of returning the N/A placeholder of an empty result
+    with pytest.raises(KeyError):
+        extract(copy.deepcopy(payload))
+    with pytest.raises(ValueError):
+        decode_stream(stream_dsr(io.BytesIO(json.dumps(payload).encode())), ['d2'])
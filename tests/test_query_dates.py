@@ -0,0 +1,83 @@
+import copy
+import io
+import json
+import os
+
+import pandas as pd
+
+from benchmarks.fixtures import query_template
+from data_transformer import (build_query_dates, decode_stream, dsr_events, split_by_date,
+                              stream_dsr, query_window)
+
+# Batched Date queries (update_stats_date): the query layout and the split of
+# a multi-date response. The fixture is synthetic: it was written by hand in
+# the DSR format for d1 and four dates, the last one with rows for a single
+# camino. It is not a capture of the real service, so two assumptions are
+# still unverified against it: that the Date literals built by
+# format_date_value are accepted in the In condition, and that the Date
+# column comes back in the Select position where build_query_dates puts it.
+# Replace it with a TRANSPORT_MODE=record capture when one is available.
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'pbi_multi_date_response.json')
+DATES = ['01/01/2023', '02/01/2023', '03/01/2023', '04/01/2023']
+
+
+def date_template():
+    template = query_template()
+    query = template['queries'][0]['Query']['Commands'][0]['SemanticQueryDataShapeCommand']['Query']
+    query['Where'] = [{"Condition": {"In": {
+        "Expressions": [{"Column": {"Expression": {"SourceRef": {"Source": "ym"}}, "Property": "Date"}}],
+        "Values": [[{"Literal": {"Value": "'01/01/2023'"}}]]}}}]
+    return template
+
+
+def command(payload):
+    return payload['queries'][0]['Query']['Commands'][0]['SemanticQueryDataShapeCommand']
+
+
+def recorded_response():
+    with open(FIXTURE, 'rb') as fixture_file:
+        return fixture_file.read()
+
+
+def test_date_column_goes_before_the_measure():
+    payload = build_query_dates(date_template(), ['d1', 'd5'], DATES)
+    select = command(payload)['Query']['Select']
+    assert [entry['Column']['Property'] if 'Column' in entry else entry['Measure']['Property']
+            for entry in select] == ['Camino', 'Pais', 'Date', 'Peregrinos']
+    assert command(payload)['Binding']['Primary']['Groupings'][0]['Projections'] == [0, 1, 2, 3]
+    values = command(payload)['Query']['Where'][0]['Condition']['In']['Values']
+    assert values == [[{'Literal': {'Value': f"'{date}'"}}] for date in DATES]
+    assert query_window(json.dumps(payload)) == 30000
+
+
+def test_recorded_response_splits_by_date():
+    df = decode_stream(stream_dsr(io.BytesIO(recorded_response())), ['d1'])
+    assert list(df.columns) == ['Camino', 'Date', 'M0']
+
+    frames = split_by_date(df, DATES, ['d1'])
+    assert list(frames) == DATES
+    for frame in frames.values():
+        assert list(frame.columns) == ['Camino', 'M0']
+        assert frame['M0'].dtype == 'int64'
+
+    assert frames['01/01/2023'].to_dict('records') == [
+        {'Camino': 'Francés', 'M0': 155}, {'Camino': 'Portugués', 'M0': 520},
+        {'Camino': 'Norte', 'M0': 247}, {'Camino': 'Primitivo', 'M0': 229},
+        {'Camino': 'Inglés', 'M0': 51}, {'Camino': 'N/A', 'M0': 148}]
+    assert frames['04/01/2023'].to_dict('records') == [{'Camino': 'Francés', 'M0': 375}]
+    assert sum(int(frame['M0'].sum()) for frame in frames.values()) == int(df['M0'].sum()) == 5416
+
+
+def test_columns_are_matched_by_name_not_position():
+    # descriptor in the old query order (measure before Date): the DM0
+    # columns still come as G0, G1, M0 and must keep their names
+    expected = decode_stream(stream_dsr(io.BytesIO(recorded_response())), ['d1'])
+    payload = json.loads(recorded_response())
+    select = payload['results'][0]['result']['data']['descriptor']['Select']
+    reordered = copy.deepcopy(payload)
+    reordered['results'][0]['result']['data']['descriptor']['Select'] = [select[0], select[2], select[1]]
+
+    df = decode_stream(dsr_events(reordered), ['d1'])
+    assert list(df.columns) == ['Camino', 'M0', 'Date']
+    pd.testing.assert_frame_equal(df[expected.columns], expected)
@@ -0,0 +1,225 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+from config import *
+
+# Shared HTTP transport for the Power BI and website calls: one keep-alive
+# session per process with a connection pool, so consecutive queries reuse
+# the same TCP/TLS connection instead of paying a new handshake each time.
+#
+# With TRANSPORT_MODE=record every successful response is also written to a
+# gzip file in TRANSPORT_ARCHIVE_DIR, named after a hash of the method, URL
+# and request body; TRANSPORT_MODE=replay serves those files instead of going
+# to the network, so refreshes can be rerun offline.
+
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+# bytes de la última respuesta de cada hilo, para atribuirlos a una tabla
+_last_request = threading.local()
+
+_counters = {
+    'requests': 0,
+    'bytes_wire': 0,
+    'bytes_decoded': 0,
+}
+
+
+def get_session():
+    global _session, _session_pid
+    with _lock:
+        # gunicorn workers must not share sockets created in the master
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                  pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            # gzip/deflate always, br/zstd when urllib3 can decode them
+            session.headers['Accept-Encoding'] = make_headers(
+                accept_encoding=True)['accept-encoding']
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+class CountingReader:
+    """File-like wrapper over a streamed body that counts the decoded bytes.
+
+    With `keep=True` it also keeps what was read, to archive it afterwards.
+    """
+
+    def __init__(self, raw, keep=False):
+        self.raw = raw
+        self.bytes_read = 0
+        self.chunks = [] if keep else None
+
+    def read(self, size=-1):
+        chunk = self.raw.read(size)
+        self.bytes_read += len(chunk)
+        if self.chunks is not None:
+            self.chunks.append(chunk)
+        return chunk
+
+
+class ArchiveMiss(requests.RequestException):
+    """Replay mode found no recorded response for the request."""
+
+
+def archive_key(method, url, data=None, json_body=None):
+    # Las queries llegan como dict o ya serializadas: se normalizan para que
+    # la misma query dé la misma clave en los dos casos
+    if json_body is None and data is not None:
+        try:
+            json_body = json.loads(data)
+        except ValueError:
+            json_body = None
+    if json_body is not None:
+        body = json.dumps(json_body, sort_keys=True, separators=(',', ':')).encode()
+    else:
+        body = data if isinstance(data, bytes) else (data or '').encode()
+    digest = hashlib.sha256(f"{method.upper()} {url}\n".encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def _archive_path(key):
+    return os.path.join(TRANSPORT_ARCHIVE_DIR, key + '.gz')
+
+
+def _save(key, response, body):
+    # Primera línea: estado y cabeceras en JSON; después, el cuerpo decodificado
+    os.makedirs(TRANSPORT_ARCHIVE_DIR, exist_ok=True)
+    meta = {'status': response.status_code, 'url': response.url,
+            'content_type': response.headers.get('Content-Type')}
+    tmp_file = f"{_archive_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with gzip.open(tmp_file, 'wb') as archive_file:
+        archive_file.write(json.dumps(meta).encode() + b'\n')
+        archive_file.write(body)
+    os.replace(tmp_file, _archive_path(key))
+
+
+def read_archive(path):
+    """Returns (meta, body) of a response saved by record mode."""
+    with gzip.open(path, 'rb') as archive_file:
+        meta = json.loads(archive_file.readline())
+        body = archive_file.read()
+    return meta, body
+
+
+def _load(key, url):
+    try:
+        meta, body = read_archive(_archive_path(key))
+    except FileNotFoundError:
+        raise ArchiveMiss(f"No recorded response for {url} ({key})")
+
+    if REPLAY_LATENCY or REPLAY_JITTER:
+        time.sleep(REPLAY_LATENCY + random.uniform(0, REPLAY_JITTER))
+
+    response = requests.Response()
+    response.status_code = meta['status']
+    response.url = meta.get('url') or url
+    if meta.get('content_type'):
+        response.headers['Content-Type'] = meta['content_type']
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers) or 'utf-8'
+    response._content = body
+
+    _last_request.bytes = (0, len(body))
+    with _lock:
+        _counters['requests'] += 1
+        _counters['bytes_decoded'] += len(body)
+    return response
+
+
+def _key_for(method, url, kwargs):
+    return archive_key(method, url, kwargs.get('data'), kwargs.get('json'))
+
+
+def _record(response, bytes_decoded):
+    # tell() returns the bytes pulled from the socket, before decompression
+    bytes_wire = response.raw.tell()
+    _last_request.bytes = (bytes_wire, bytes_decoded)
+    with _lock:
+        _counters['requests'] += 1
+        _counters['bytes_wire'] += bytes_wire
+        _counters['bytes_decoded'] += bytes_decoded
+
+
+def last_request_bytes():
+    """Returns (bytes_wire, bytes_decoded) of the last request made by this thread."""
+    return getattr(_last_request, 'bytes', (0, 0))
+
+
+def request(method, url, **kwargs):
+    if TRANSPORT_MODE == 'replay':
+        return _load(_key_for(method, url, kwargs), url)
+
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    response = get_session().request(method, url, **kwargs)
+    _record(response, len(response.content))
+    if TRANSPORT_MODE == 'record' and response.ok:
+        _save(_key_for(method, url, kwargs), response, response.content)
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+@contextmanager
+def stream(method, url, **kwargs):
+    # Yields a reader over the decoded body; the connection goes back to the
+    # pool once the body has been consumed
+    if TRANSPORT_MODE == 'replay':
+        response = _load(_key_for(method, url, kwargs), url)
+        response.raise_for_status()
+        yield io.BytesIO(response.content)
+        return
+
+    recording = TRANSPORT_MODE == 'record'
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    with get_session().request(method, url, stream=True, **kwargs) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        reader = CountingReader(response.raw, keep=recording)
+        yield reader
+        _record(response, reader.bytes_read)
+        if recording:
+            # solo se guardan las respuestas leídas hasta el final
+            if reader.raw.read(1) == b'':
+                _save(_key_for(method, url, kwargs), response, b''.join(reader.chunks))
+
+
+def transport_stats():
+    new_connections = 0
+    pool_requests = 0
+    session = _session
+    if session is not None and _session_pid == os.getpid():
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            with pools.lock:
+                connection_pools = list(pools._container.values())
+            for pool in connection_pools:
+                new_connections += pool.num_connections
+                pool_requests += pool.num_requests
+
+    with _lock:
+        stats = dict(_counters)
+    stats['new_connections'] = new_connections
+    stats['reused_connections'] = max(pool_requests - new_connections, 0)
+    return stats